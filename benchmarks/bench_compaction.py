@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark message compaction on recorded or synthetic agent transcripts
+
+A transcript is the sequence of chat completion requests of one session, read
+from a JSON Lines file of request bodies or from the "Request body:" lines that
+debug mode writes to debug_request.log. Without transcripts, a synthetic coding
+agent session that rereads files and repeats tool outputs is used.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import trae_proxy
+from trae_proxy import compact_messages, estimate_request_tokens
+
+def load_transcript(path):
+    """Read the request bodies of a transcript file as JSON strings"""
+    bodies = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            marker = line.find("Request body: ")
+            text = line[marker + len("Request body: "):] if marker >= 0 else line
+            text = text.strip()
+            if not text.startswith("{"):
+                continue
+            try:
+                if isinstance(json.loads(text).get("messages"), list):
+                    bodies.append(text)
+            except ValueError:
+                continue
+    return bodies
+
+def synthetic_transcript(turns=40, seed=1):
+    """Build an agent session that reads and edits files, runs tests and pastes open files back"""
+    rng = random.Random(seed)
+
+    def render(index, version):
+        return "".join(
+            f"def function_{index}_{j}(value):\n    return value * {j} + {version}  # {'x' * (20 + (j * 7) % 40)}\n"
+            for j in range(60)
+        )
+
+    versions = [0] * 8
+    messages = [
+        {"role": "system", "content": "You are a coding agent. Use the tools to read and edit files."},
+        {"role": "user", "content": "Refactor the modules under src/ so that every function validates its input."},
+    ]
+    bodies = []
+    for turn in range(turns):
+        index = rng.randrange(len(versions))
+        name = f"src/module_{index}.py"
+        call_id = f"call_{turn}"
+        if rng.random() < 0.6:
+            tool, arguments, output = "read_file", {"path": name}, render(index, versions[index])
+        else:
+            # Test runs print a different log every time
+            tool, arguments = "run_tests", {"path": "tests/"}
+            output = "".join(f"tests/test_{i}.py::test_case_{j} {rng.choice(['PASSED', 'FAILED'])}\n"
+                             for i in range(8) for j in range(12))
+        messages.append({
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{"id": call_id, "type": "function",
+                            "function": {"name": tool, "arguments": json.dumps(arguments)}}]
+        })
+        messages.append({"role": "tool", "tool_call_id": call_id, "content": output})
+        if turn % 5 == 4:
+            # The IDE attaches the open file to the user's follow-up
+            messages.append({
+                "role": "user",
+                "content": f"Here is the current {name}, keep its interface:\n```python\n{render(index, versions[index])}```\nContinue."
+            })
+        bodies.append(json.dumps({"model": "gpt-4", "stream": True, "messages": messages}, ensure_ascii=False))
+        if rng.random() < 0.3:
+            versions[index] += 1
+            messages.append({"role": "assistant", "content": f"Edited {name}."})
+        else:
+            messages.append({"role": "assistant", "content": f"Checked {name}."})
+    return bodies
+
+def run(name, bodies):
+    """Compact each request of a transcript in order and report the savings"""
+    original_bytes = compacted_bytes = original_tokens = compacted_tokens = 0
+    elapsed = 0.0
+    duplicates = stale = 0
+    # Provider prompt caches only hit while the previous request stays a prefix of the next
+    previous = []
+    prefix_kept = 0
+    for body in bodies:
+        req_json = json.loads(body)
+        original_bytes += len(body.encode("utf-8"))
+        original_tokens += estimate_request_tokens(req_json)
+        started = time.perf_counter()
+        stats = compact_messages(req_json, session_key=name)
+        elapsed += time.perf_counter() - started
+        compacted_bytes += len(json.dumps(req_json, ensure_ascii=False).encode("utf-8"))
+        compacted_tokens += estimate_request_tokens(req_json)
+        current = [json.dumps(message, sort_keys=True) for message in req_json["messages"]]
+        if previous and current[:len(previous)] == previous:
+            prefix_kept += 1
+        previous = current
+        if stats:
+            duplicates += stats["duplicate_blocks"]
+            stale += stats["stale_blocks"]
+    saved = 1 - compacted_bytes / original_bytes if original_bytes else 0.0
+    print(f"{name}: {len(bodies)} requests, {duplicates} duplicate and {stale} stale blocks compacted")
+    print(f"  upload: {original_bytes / 1024:.1f} KB -> {compacted_bytes / 1024:.1f} KB ({saved:.1%} saved)")
+    print(f"  estimated prompt tokens: {original_tokens} -> {compacted_tokens}")
+    print(f"  previous request kept as prefix: {prefix_kept} of {max(len(bodies) - 1, 0)} requests")
+    print(f"  compaction time: {elapsed / max(len(bodies), 1) * 1e3:.3f} ms per request")
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Benchmark message compaction on agent transcripts")
+    parser.add_argument("transcripts", nargs="*", help="JSON Lines request bodies or debug_request.log files")
+    parser.add_argument("--min-chars", type=int, default=trae_proxy.COMPACTION_MIN_CHARS)
+    parser.add_argument("--duplicates", choices=["reference", "truncate", "keep"], default=trae_proxy.COMPACTION_DUPLICATES)
+    parser.add_argument("--stale-after", type=int, default=10, help="stale_after_requests (0 disables)")
+    parser.add_argument("--stale-batch", type=int, default=trae_proxy.COMPACTION_STALE_BATCH)
+    args = parser.parse_args()
+
+    trae_proxy.COMPACTION_MIN_CHARS = args.min_chars
+    trae_proxy.COMPACTION_DUPLICATES = args.duplicates
+    trae_proxy.COMPACTION_STALE_AFTER = args.stale_after
+    trae_proxy.COMPACTION_STALE_BATCH = max(args.stale_batch, 1)
+
+    if args.transcripts:
+        for path in args.transcripts:
+            bodies = load_transcript(path)
+            if not bodies:
+                print(f"{path}: no chat completion requests found")
+                continue
+            run(path, bodies)
+    else:
+        run("synthetic agent session", synthetic_transcript())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Check and benchmark the shared state stores
+
+The redis store talks to a small in-process RESP server standing in for Redis, which can
+also drop connections to check that lost replies and stale connections never count twice.
+The shm store uses a table in a temporary directory. Exits non-zero if a count is wrong.
+"""
+
+import argparse
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trae_proxy import (BatchedCounters, LocalStateStore, RedisStateStore,
+                        SharedMemoryStateStore, StateStoreError)
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """RESP server with the commands the proxy uses: INCRBY, GET, PEXPIRE, PING, AUTH and SELECT"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.values = {}
+        self.lock = threading.Lock()
+        # Number of upcoming pipelines to apply and then answer by closing the connection
+        self.drop_replies = 0
+        # While set, commands are read but never answered, like a hung server
+        self.stalled = False
+        self.connections = []
+
+    def close_idle_connections(self):
+        """Close every open connection, as a server restart or idle timeout would"""
+        for sock in self.connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def parse_commands(buffer):
+    """Split the complete RESP commands off the front of buffer"""
+    commands = []
+    while buffer.startswith(b'*'):
+        end = buffer.find(b'\r\n')
+        if end < 0:
+            break
+        command, position = [], end + 2
+        for _ in range(int(buffer[1:end])):
+            end = buffer.find(b'\r\n', position)
+            if end < 0:
+                break
+            start = end + 2
+            length = int(buffer[position + 1:end])
+            if len(buffer) < start + length + 2:
+                break
+            command.append(buffer[start:start + length].decode('utf-8'))
+            position = start + length + 2
+        else:
+            commands.append(command)
+            buffer = buffer[position:]
+            continue
+        break
+    return commands, buffer
+
+class StandInHandler(socketserver.BaseRequestHandler):
+
+    def apply(self, command):
+        server = self.server
+        name = command[0].upper()
+        with server.lock:
+            if name == 'INCRBY':
+                server.values[command[1]] = server.values.get(command[1], 0) + int(command[2])
+                return b':%d\r\n' % server.values[command[1]]
+            if name == 'GET':
+                value = server.values.get(command[1])
+                if value is None:
+                    return b'$-1\r\n'
+                data = str(value).encode('utf-8')
+                return b'$%d\r\n%s\r\n' % (len(data), data)
+            if name == 'PEXPIRE':
+                return b':1\r\n'
+            if name in ('PING', 'AUTH', 'SELECT'):
+                return b'+OK\r\n' if name != 'PING' else b'+PONG\r\n'
+        return b'-ERR unknown command\r\n'
+
+    def handle(self):
+        self.server.connections.append(self.request)
+        buffer = b''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            commands, buffer = parse_commands(buffer + data)
+            if not commands or self.server.stalled:
+                continue
+            # A pipeline is applied as a whole before it is answered
+            replies = [self.apply(command) for command in commands]
+            with self.server.lock:
+                drop = self.server.drop_replies > 0
+                if drop:
+                    self.server.drop_replies -= 1
+            if drop:
+                return
+            self.request.sendall(b''.join(replies))
+
+def check(name, actual, expected):
+    if actual != expected:
+        print(f"  FAIL {name}: got {actual}, expected {expected}")
+        return False
+    print(f"  ok   {name}")
+    return True
+
+def check_concurrent_counts(store, threads, increments):
+    """Workers add through their own BatchedCounters and flush concurrently"""
+    key = f"bench:{store.name}:{time.monotonic_ns()}"
+
+    def worker():
+        counters = BatchedCounters(store)
+        for i in range(increments):
+            counters.add(key)
+            if i % 100 == 99:
+                counters.flush()
+        counters.flush()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return check(f"{threads} workers x {increments} increments", store.get(key), threads * increments)
+
+def check_redis_failures(server, store):
+    """Lost replies must not be resent; stale connections must be replaced before sending"""
+    ok = True
+    counters = BatchedCounters(store)
+    counters.add('lost', 5)
+    counters.add('lost-ttl', 7, ttl=60)
+    server.drop_replies = 1
+    counters.flush()
+    ok &= check("pipeline applied but reply lost is not resent", server.values.get(RedisStateStore.PREFIX + 'lost'), 5)
+    ok &= check("delta of a sent pipeline is not kept for the next flush", counters.pending.get('lost'), None)
+    counters.flush()
+    ok &= check("expiring key is added once", server.values.get(RedisStateStore.PREFIX + 'lost-ttl'), 7)
+
+    store.incr('stale', 1)
+    server.close_idle_connections()
+    time.sleep(0.05)
+    store.incr('stale', 1)
+    ok &= check("stale connection is replaced before sending", server.values.get(RedisStateStore.PREFIX + 'stale'), 2)
+
+    server.drop_replies = 1
+    ok &= check("idempotent read is retried after a lost reply", store.get('stale'), 2)
+    return ok
+
+def check_redis_outage(server, threads):
+    """A hung server costs one timeout, then calls fail fast until retry_interval has passed"""
+    store = RedisStateStore(f"redis://127.0.0.1:{server.server_address[1]}/0", timeout=0.2, retry_interval=0.5)
+    store.execute([('PING',)])
+    server.stalled = True
+    durations = []
+
+    def call():
+        started = time.perf_counter()
+        try:
+            store.incr('outage', 1)
+        except StateStoreError:
+            pass
+        durations.append(time.perf_counter() - started)
+
+    try:
+        workers = [threading.Thread(target=call) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        ok = check(f"{threads} concurrent calls to a hung server wait for one timeout", max(durations) < 0.35, True)
+        durations.clear()
+        call()
+        ok &= check("calls during retry_interval fail at once", durations[0] < 0.05, True)
+    finally:
+        server.stalled = False
+    time.sleep(0.5)
+    ok &= check("the server is used again after retry_interval", store.incr('outage', 1) > 0, True)
+    return ok
+
+def check_shm_full(directory):
+    """A full table adds the keys that fit and keeps only the rest for the next flush"""
+    store = SharedMemoryStateStore(os.path.join(directory, 'full_state'), 4)
+    counters = BatchedCounters(store)
+    for i in range(6):
+        counters.add(f"key-{i}", 1)
+    counters.flush()
+    stored = sum(store.get(f"key-{i}") for i in range(6))
+    ok = check("keys that fit are stored once", stored, 4)
+    ok &= check("only unapplied deltas are kept", sum(counters.pending.values()), 6 - stored)
+    counters.flush()
+    ok &= check("a second flush does not add stored keys again", sum(store.get(f"key-{i}") for i in range(6)), stored)
+    return ok
+
+def measure(store, operations):
+    """Time single increments and batched flushes of 50 keys"""
+    started = time.perf_counter()
+    for i in range(operations):
+        store.incr('bench:single', 1)
+    single = time.perf_counter() - started
+    deltas = {f"bench:batch:{i}": 1 for i in range(50)}
+    batches = max(operations // 50, 1)
+    started = time.perf_counter()
+    for _ in range(batches):
+        store.incr_many(deltas)
+    batched = time.perf_counter() - started
+    print(f"  incr: {single / operations * 1e6:.1f} us per call, "
+          f"incr_many of 50 keys: {batched / batches * 1e6:.1f} us per call")
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Check and benchmark the shared state stores")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--increments", type=int, default=2000)
+    parser.add_argument("--operations", type=int, default=5000)
+    args = parser.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        server = StandInServer()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stores = [
+            LocalStateStore(),
+            SharedMemoryStateStore(os.path.join(directory, 'state'), 4096),
+            # The failure checks below expect every call to reach the stand-in
+            RedisStateStore(f"redis://127.0.0.1:{server.server_address[1]}/0", retry_interval=0),
+        ]
+        for store in stores:
+            print(f"{store.name}:")
+            try:
+                ok &= check_concurrent_counts(store, args.threads, args.increments)
+                if store.name == 'redis':
+                    ok &= check_redis_failures(server, store)
+                    ok &= check_redis_outage(server, args.threads)
+                elif store.name == 'shm':
+                    ok &= check_shm_full(directory)
+                measure(store, args.operations)
+            except StateStoreError as e:
+                print(f"  FAIL {e}")
+                ok = False
+        server.shutdown()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark proxy startup: import time and time from process start until /healthz answers"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def free_port():
+    """Pick an unused local port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def write_config(directory, endpoint, backends=20):
+    """Write a configuration with several backends pointing at one endpoint"""
+    lines = ["domain: api.openai.com", "apis:"]
+    for i in range(backends):
+        lines += [
+            f"- name: backend-{i}",
+            f"  endpoint: {endpoint}",
+            f"  custom_model_id: model-{i}",
+            f"  target_model_id: upstream-model-{i}",
+            "  stream_mode: null",
+            "  active: true",
+        ]
+    lines += ["server:", "  port: 8443", "  debug: false"]
+    path = os.path.join(directory, "config.yaml")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+def healthz_ok(port):
+    """Whether the proxy on port answers GET /healthz with 200"""
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+            sock.sendall(b"GET /healthz HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n")
+            status_line = sock.recv(64).split(b"\r\n", 1)[0]
+            return status_line.split(b" ")[1:2] == [b"200"]
+    except OSError:
+        return False
+
+def time_to_ready(cmd, port, timeout=30):
+    """Seconds from spawning cmd until the proxy answers on port"""
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"{' '.join(cmd)} exited with {process.returncode}")
+            if healthz_ok(port):
+                return time.perf_counter() - started
+            time.sleep(0.002)
+        raise RuntimeError(f"{' '.join(cmd)} was not ready within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+def time_import(runs):
+    """Median seconds to start an interpreter and import trae_proxy"""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import trae_proxy"], cwd=ROOT, check=True)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description='Benchmark proxy startup')
+    parser.add_argument('--runs', type=int, default=10, help='Rounds to run (default 10)')
+    parser.add_argument('--endpoint', default='http://127.0.0.1:9',
+                        help='Backend endpoint; a real upstream also measures the cost of warm-up (default: a closed local port)')
+    args = parser.parse_args()
+
+    print(f"Interpreter + import trae_proxy: {time_import(args.runs) * 1000:.0f} ms (median of {args.runs})")
+    with tempfile.TemporaryDirectory() as directory:
+        config = write_config(directory, args.endpoint)
+        snapshot = os.path.join(directory, ".config.yaml.snapshot.json")
+        python = sys.executable
+        proxy = [python, "trae_proxy.py", "--http-mode", "--config", config]
+        cli = [python, "trae_proxy_cli.py", "--config", config, "start", "--http-mode"]
+        modes = [
+            ("proxy, YAML config", proxy, True),
+            ("proxy, config snapshot", proxy, False),
+            ("cli start (supervised)", cli, False),
+            ("cli start --single-process", cli + ["--single-process"], False),
+        ]
+
+        # Interleave the modes so that machine noise affects them alike
+        samples = {label: [] for label, _, _ in modes}
+        for _ in range(args.runs):
+            for label, cmd, cold in modes:
+                if cold and os.path.exists(snapshot):
+                    os.remove(snapshot)
+                port = free_port()
+                samples[label].append(time_to_ready(cmd + ["--port", str(port)], port))
+
+        for label, _, _ in modes:
+            print(f"{label}: {statistics.median(samples[label]) * 1000:.0f} ms to first /healthz (median of {args.runs})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark the local prompt token estimator on a 100 KB chat request"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trae_proxy import estimate_request_tokens
+
+def build_request(size=100 * 1024):
+    """Build a chat request whose message contents total about size bytes"""
+    code = "def handler(event, context):\n    return {'status': 200, 'body': event['payload']}\n"
+    mixed = "请重构这个函数并保持接口不变。"
+    chunk = code * 8 + mixed
+    messages = [{"role": "system", "content": "You are a coding assistant."}]
+    total = 0
+    while total < size:
+        messages.append({"role": "user", "content": chunk})
+        messages.append({"role": "assistant", "content": code})
+        total += len(chunk.encode('utf-8')) + len(code)
+    return {"model": "gpt-4", "messages": messages}
+
+def main():
+    """Main function"""
+    req_json = build_request()
+    runs = 2000
+    seconds = timeit.timeit(lambda: estimate_request_tokens(req_json), number=runs)
+    print(f"Messages: {len(req_json['messages'])}, estimated tokens: {estimate_request_tokens(req_json)}")
+    print(f"Mean estimation time: {seconds / runs * 1e6:.1f} us per 100 KB request")
+
+if __name__ == "__main__":
+    main()
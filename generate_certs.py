@@ -7,6 +7,16 @@ import subprocess
 import tempfile
 import atexit
 import shutil
+import datetime
+
+# In-process certificate generation (pip install cryptography); falls back to the openssl CLI
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+    x509 = None
 
 # Temporary file list for cleanup on exit
 temp_files = []
@@ -210,6 +220,95 @@ def generate_server_cert(domain="api.openai.com"):
 
     print(f"Server certificate generation completed: ca/{domain}.crt")
 
+def write_private_key(path, key):
+    """Write an unencrypted PKCS#8 private key readable only by the owner"""
+    data = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+def write_certificate(path, cert):
+    """Write a PEM certificate"""
+    with open(path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+def generate_certs_in_process(domain="api.openai.com"):
+    """Generate the CA and server certificate in-process, without subprocesses or temp files
+
+    Keys are ECDSA P-256, which makes server handshakes cheaper than RSA 2048.
+    """
+    os.makedirs("ca", exist_ok=True)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    print("Generating CA certificate...")
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "CN"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "State"),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, "City"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "TraeProxy CA"),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "TraeProxy"),
+        x509.NameAttribute(NameOID.COMMON_NAME, "TraeProxy Root CA"),
+    ])
+    ca_ski = x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key())
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(ca_name)
+        .issuer_name(ca_name)
+        .public_key(ca_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=36500))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.KeyUsage(
+            digital_signature=True, content_commitment=False, key_encipherment=False,
+            data_encipherment=False, key_agreement=False, key_cert_sign=True, crl_sign=True,
+            encipher_only=False, decipher_only=False
+        ), critical=True)
+        .add_extension(ca_ski, critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+    write_private_key("ca/ca.key", ca_key)
+    write_certificate("ca/ca.crt", ca_cert)
+    print("CA certificate generation completed")
+
+    print(f"Generating server certificate for domain {domain}...")
+    server_key = ec.generate_private_key(ec.SECP256R1())
+    server_name = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "CN"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "State"),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, "City"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Organization"),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Unit"),
+        x509.NameAttribute(NameOID.COMMON_NAME, domain),
+    ])
+    server_cert = (
+        x509.CertificateBuilder()
+        .subject_name(server_name)
+        .issuer_name(ca_name)
+        .public_key(server_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=365))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+        .add_extension(x509.KeyUsage(
+            digital_signature=True, content_commitment=True, key_encipherment=False,
+            data_encipherment=False, key_agreement=False, key_cert_sign=False, crl_sign=False,
+            encipher_only=False, decipher_only=False
+        ), critical=False)
+        .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain)]), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ca_ski), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+    write_private_key(f"ca/{domain}.key", server_key)
+    write_certificate(f"ca/{domain}.crt", server_cert)
+    print(f"Server certificate generation completed: ca/{domain}.crt")
+
 def main():
     """Main function"""
     # Parse command line arguments
@@ -217,6 +316,12 @@ def main():
     if len(sys.argv) > 1 and sys.argv[1] == "--domain" and len(sys.argv) > 2:
         domain = sys.argv[2]
 
+    # Generate in-process when the cryptography package is available
+    if x509 is not None:
+        generate_certs_in_process(domain)
+        print("All certificate generation completed")
+        return
+
     # Check OpenSSL
     check_openssl()
 
@@ -1,17 +1,57 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, Response, jsonify, stream_with_context
+from flask import Flask, request, Response, jsonify, stream_with_context, g
 import requests
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+import hashlib
+import hmac
+import io
 import json
+import math
+import mmap
+import re
+import select
 import ssl
+import socket
+import struct
 import argparse
+import bisect
+import gzip
 import logging
 import os
 import sys
-import yaml
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
 
+# File locking for the on-disk completion cache (not available on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Process peak RSS for /admin/stats (not available on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Optional Brotli support for compressed bodies (pip install brotli)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Optional HTTP/2 upstream transport (pip install "httpx[http2]"), imported by the first HTTP/2 request
+httpx = None
+HTTPX_IMPORT_ATTEMPTED = False
+
 # Default configuration
 TARGET_API_BASE_URL = "https://api.openai.com"
 CUSTOM_MODEL_ID = "gpt-4"
@@ -23,9 +63,162 @@ DEBUG_MODE = False
 CERT_FILE = os.path.join("ca", "api.openai.com.crt")
 KEY_FILE = os.path.join("ca", "api.openai.com.key")
 
+# TLS serving settings (overridable via server.tls in config.yaml)
+TLS_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20"
+TLS_NUM_TICKETS = 2
+TLS_RELOAD_INTERVAL = 60
+
 # Multi-backend configuration
 MULTI_BACKEND_CONFIG = None
 
+# Body compression (overridable via server.compression in config.yaml)
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+DECOMPRESS_CHUNK_SIZE = 65536
+
+# Request tracing and slow-request flight recorder (overridable via server.tracing)
+TRACING_ENABLED = True
+TRACING_SLOW_THRESHOLD = 5.0
+TRACING_EXPORT_FILE = None
+SLOW_REQUESTS = deque(maxlen=100)
+TRACE_EXPORT_LOCK = threading.Lock()
+
+# Anonymized traffic capture for offline replay (overridable via server.capture)
+CAPTURE_ENABLED = False
+CAPTURE_FILE = "capture.jsonl"
+CAPTURE_MAX_CHUNKS = 4096
+CAPTURE_HANDLE = None
+CAPTURE_LOCK = threading.Lock()
+
+# On-demand sampling profiler limits
+PROFILE_MAX_SECONDS = 60
+PROFILE_LOCK = threading.Lock()
+
+# Admin endpoints token (server.admin_token); without one admin endpoints are refused unless
+# server.admin_allow_loopback trusts loopback clients (unsafe behind a same-host reverse proxy)
+ADMIN_TOKEN = None
+ADMIN_ALLOW_LOOPBACK = False
+
+# Precomputed /v1/models response (body, etag, {encoding: (body, etag)}) and merged upstream model metadata
+MODELS_RESPONSE = None
+MODELS_MERGE_UPSTREAM = False
+MODELS_UPSTREAM_TTL = 300
+UPSTREAM_MODELS = {}
+
+# Prompt-prefix affinity routing (overridable via server.routing in config.yaml)
+AFFINITY_MESSAGES = 1
+AFFINITY_PREFIX_CHARS = 8192
+AFFINITY_LOAD_FACTOR = 1.25
+AFFINITY_VIRTUAL_NODES = 64
+HASH_RINGS = {}
+
+# Cost- and quota-aware routing among equivalent backends (server.routing.strategy: cost)
+ROUTING_STRATEGY = "affinity"
+EXPECTED_COMPLETION_TOKENS = 500
+LATENCY_SLO_MS = None
+UNHEALTHY_AFTER = 3
+UNHEALTHY_COOLDOWN = 30
+QUOTA_UTC_OFFSET_HOURS = 0
+QUOTA_KEY_TTL = 2 * 86400
+
+# Per-backend tokens-per-minute buckets, keyed by backend name
+TPM_BUCKETS = {}
+TPM_BUCKETS_LOCK = threading.Lock()
+
+# In-flight upstream requests per backend name
+BACKEND_INFLIGHT = {}
+BACKEND_INFLIGHT_LOCK = threading.Lock()
+
+# Shared state for TPM limits and backend stats across workers (server.shared_state)
+SHARED_STATE_BACKEND = "local"
+SHARED_STATE_PATH = None
+SHARED_STATE_SLOTS = 4096
+SHARED_STATE_URL = "redis://127.0.0.1:6379/0"
+SHARED_STATE_LEASE_FRACTION = 0.05
+SHARED_STATE_FLUSH_INTERVAL = 1.0
+SHARED_STATE_RETRY_INTERVAL = 5.0
+SHARED_STATE = None
+BACKEND_STATS = None
+STAT_FIELDS = ('requests', 'errors', 'prompt_tokens', 'usage_prompt_tokens', 'usage_completion_tokens', 'spend_micros')
+
+# Upstream timeouts in seconds (server.timeouts, overridable per apis entry and per request)
+DEFAULT_TIMEOUTS = {'connect': 10, 'ttfb': 300, 'idle': 120, 'total': 900}
+ADAPTIVE_TIMEOUTS = False
+ADAPTIVE_MIN_SAMPLES = 20
+ADAPTIVE_MULTIPLIER = 3.0
+ADAPTIVE_FLOOR = 5.0
+LATENCY_SAMPLES = {}
+LATENCY_SAMPLES_LOCK = threading.Lock()
+
+# Upstream connection settings (overridable via server.upstream in config.yaml)
+UPSTREAM_PRECONNECT = 2
+UPSTREAM_POOL_MAXSIZE = 32
+UPSTREAM_CONNECT_TIMEOUT = 10
+DNS_CACHE_TTL = 60
+
+# Shared upstream session, DNS cache and the original resolver
+UPSTREAM_SESSION = None
+UPSTREAM_SESSION_LOCK = threading.Lock()
+DNS_CACHE = {}
+DNS_CACHE_LOCK = threading.Lock()
+_original_getaddrinfo = socket.getaddrinfo
+
+# HTTP/2 clients keyed by endpoint, used by backends with http2: true
+HTTP2_CLIENTS = {}
+HTTP2_CLIENTS_LOCK = threading.Lock()
+HTTP2_MAX_CONNECTIONS = 4
+
+# Generic /v1/* passthrough settings
+PASSTHROUGH_PEEK_SIZE = 65536
+PASSTHROUGH_CHUNK_SIZE = 65536
+MODEL_FIELD_PATTERN = re.compile(rb'"model"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Chat completion body limits and buffering (overridable via server.limits in config.yaml)
+MAX_REQUEST_BODY = 32 * 1024 * 1024
+STREAM_UPLOAD_THRESHOLD = 1024 * 1024
+USAGE_TAIL_SIZE = 4096
+USAGE_FIELD_PATTERN = re.compile(rb'"usage"\s*:\s*(\{(?:[^{}]|\{[^{}]*\})*\})')
+REQUEST_MEMORY_SAMPLES = deque(maxlen=1000)
+
+# Compaction of repeated and stale context in chat messages (opt-in via server.compaction in config.yaml)
+COMPACTION_ENABLED = False
+COMPACTION_MIN_CHARS = 2048
+COMPACTION_DUPLICATES = "reference"
+COMPACTION_STALE_AFTER = 0
+COMPACTION_STALE_BATCH = 5
+COMPACTION_STALE_ROLES = ('tool',)
+COMPACTION_KEEP_HEAD = 1024
+COMPACTION_KEEP_TAIL = 512
+COMPACTION_MAX_SESSIONS = 1000
+COMPACTION_SESSION_TTL = 3600
+COMPACTION_SESSIONS = OrderedDict()
+COMPACTION_LOCK = threading.Lock()
+COMPACTION_FIELDS = (
+    'requests', 'compacted_requests', 'duplicate_blocks', 'stale_blocks', 'bytes_saved', 'tokens_saved', 'resent_bytes'
+)
+FENCED_BLOCK_PATTERN = re.compile(r'^```[^\n]*\n.*?^```[ \t]*$', re.M | re.S)
+# Embeddings micro-batching (overridable via server.embeddings_batching in config.yaml)
+EMBEDDINGS_BATCHING = False
+EMBEDDINGS_BATCH_WINDOW = 0.01
+EMBEDDINGS_BATCH_MAX_INPUTS = 256
+EMBEDDINGS_BATCH_MAX_BODY = 65536
+EMBEDDING_BATCHER = None
+
+# On-disk completion cache (overridable via server.completion_cache in config.yaml)
+COMPLETION_CACHE_ENABLED = False
+COMPLETION_CACHE_PATH = "cache"
+COMPLETION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+COMPLETION_CACHE_SLOTS = 65536
+COMPLETION_CACHE_TTL = 86400
+COMPLETION_CACHE = None
+
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'
+}
+
 # Initialize Flask application
 app = Flask(__name__)
 
@@ -36,6 +229,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger('trae_proxy')
 
+# Keep supervisor health probes out of the access log
+logging.getLogger('werkzeug').addFilter(lambda record: '/healthz' not in record.getMessage())
+
 @app.route('/', methods=['GET'])
 def root():
     """Handle root path requests"""
@@ -49,42 +245,345 @@ def v1_root():
     return jsonify({
         "message": "OpenAI API v1 endpoint",
         "endpoints": {
-            "chat/completions": "/v1/chat/completions"
+            "chat/completions": "/v1/chat/completions",
+            "models": "/v1/models",
+            "*": "/v1/* (forwarded to the selected backend)"
         }
     })
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness/readiness probe used by the supervisor (not traced)"""
+    return jsonify({
+        "status": "ok",
+        "pid": os.getpid(),
+        "inflight": sum(BACKEND_INFLIGHT.values())
+    })
+
+def build_models_response():
+    """Precompute the /v1/models response body and its strong ETag"""
+    global MODELS_RESPONSE
+    # Get model list from configuration
+    models = []
+    if MULTI_BACKEND_CONFIG:
+        apis = MULTI_BACKEND_CONFIG.get('apis', [])
+        for api in apis:
+            if api.get('active', False):
+                model = {
+                    "id": api.get('custom_model_id', ''),
+                    "object": "model",
+                    "created": 1,
+                    "owned_by": "trae-proxy"
+                }
+                # Merge metadata reported by the backend for its target model
+                upstream_model = UPSTREAM_MODELS.get((api.get('endpoint', '').strip(), api.get('target_model_id')))
+                if upstream_model:
+                    model.update({key: value for key, value in upstream_model.items() if key != 'id'})
+                models.append(model)
+    else:
+        models.append({
+            "id": CUSTOM_MODEL_ID,
+            "object": "model",
+            "created": 1,
+            "owned_by": "trae-proxy"
+        })
+
+    body = json.dumps({"object": "list", "data": models}, separators=(',', ':')).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    etag = f'"{digest}"'
+    # Each encoded representation gets its own strong ETag
+    variants = {}
+    if COMPRESSION_ENABLED and len(body) >= COMPRESSION_MIN_SIZE:
+        for encoding in available_encodings():
+            variants[encoding] = (compress_body(body, encoding), f'"{digest}-{encoding}"')
+    MODELS_RESPONSE = (body, etag, variants)
+    return MODELS_RESPONSE
+
+def load_models_settings():
+    """Load upstream model list merging settings from the server section of the configuration"""
+    global MODELS_MERGE_UPSTREAM, MODELS_UPSTREAM_TTL
+    if not MULTI_BACKEND_CONFIG:
+        return
+    models = (MULTI_BACKEND_CONFIG.get('server') or {}).get('models') or {}
+    MODELS_MERGE_UPSTREAM = bool(models.get('merge_upstream', MODELS_MERGE_UPSTREAM))
+    MODELS_UPSTREAM_TTL = float(models.get('upstream_ttl', MODELS_UPSTREAM_TTL))
+
+def refresh_upstream_models():
+    """Fetch each active backend's /v1/models list and rebuild the cached response"""
+    global UPSTREAM_MODELS
+    upstream_models = {}
+    for api in (MULTI_BACKEND_CONFIG or {}).get('apis', []):
+        endpoint = api.get('endpoint', '').strip()
+        if not api.get('active', False) or not endpoint:
+            continue
+        headers = {}
+        if api.get('api_key'):
+            headers['Authorization'] = f"Bearer {api['api_key']}"
+        try:
+            response = get_upstream_session().get(f"{endpoint}/v1/models", headers=headers, timeout=UPSTREAM_CONNECT_TIMEOUT)
+            response.raise_for_status()
+            for model in response.json().get('data', []):
+                upstream_models[(endpoint, model.get('id'))] = model
+        except Exception as e:
+            logger.warning(f"Failed to fetch model list from {endpoint}: {str(e)}")
+    UPSTREAM_MODELS = upstream_models
+    build_models_response()
+
+def refresh_upstream_models_loop():
+    """Background loop refreshing merged upstream model metadata every TTL"""
+    while True:
+        refresh_upstream_models()
+        time.sleep(MODELS_UPSTREAM_TTL)
+
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     """List available models"""
     try:
-        # Get model list from configuration
-        models = []
-        if MULTI_BACKEND_CONFIG:
-            apis = MULTI_BACKEND_CONFIG.get('apis', [])
-            for api in apis:
-                if api.get('active', False):
-                    models.append({
-                        "id": api.get('custom_model_id', ''),
-                        "object": "model",
-                        "created": 1,
-                        "owned_by": "trae-proxy"
-                    })
-        else:
-            models.append({
-                "id": CUSTOM_MODEL_ID,
-                "object": "model",
-                "created": 1,
-                "owned_by": "trae-proxy"
-            })
-
-        return jsonify({
-            "object": "list",
-            "data": models
-        })
+        body, etag, variants = MODELS_RESPONSE or build_models_response()
+        headers = {'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding in variants:
+            body, etag = variants[encoding]
+            headers['Content-Encoding'] = encoding
+        headers['ETag'] = etag
+        all_etags = [etag.strip('"')] + [variant_etag.strip('"') for _, variant_etag in variants.values()]
+        if any(request.if_none_match.contains_weak(tag) for tag in all_etags):
+            headers.pop('Content-Encoding', None)
+            return Response(status=304, headers=headers)
+        return Response(body, content_type='application/json', headers=headers)
     except Exception as e:
         logger.error(f"Error listing models: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+def load_compression_settings():
+    """Load body compression settings from the server section of the configuration"""
+    global COMPRESSION_ENABLED, COMPRESSION_MIN_SIZE, COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY
+    if not MULTI_BACKEND_CONFIG:
+        return
+    compression = (MULTI_BACKEND_CONFIG.get('server') or {}).get('compression') or {}
+    COMPRESSION_ENABLED = bool(compression.get('enabled', COMPRESSION_ENABLED))
+    COMPRESSION_MIN_SIZE = int(compression.get('min_size', COMPRESSION_MIN_SIZE))
+    COMPRESSION_GZIP_LEVEL = int(compression.get('gzip_level', COMPRESSION_GZIP_LEVEL))
+    COMPRESSION_BROTLI_QUALITY = int(compression.get('brotli_quality', COMPRESSION_BROTLI_QUALITY))
+
+def available_encodings():
+    """Content codings this process can produce, most preferred first"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def negotiate_encoding(accept_encoding):
+    """Pick a response coding from an Accept-Encoding header, or None for identity"""
+    if not COMPRESSION_ENABLED or not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def compress_body(body, encoding):
+    """Compress a response body with the given content coding"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+def compress_response(response):
+    """Compress a buffered response when the client accepts it and it is large enough"""
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding is None or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+    response.set_data(compress_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def compress_stream(chunks, encoding):
+    """Compress a response body on the fly as its chunks are produced"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+class BodyDecodingError(Exception):
+    """A request body could not be decoded; carries the HTTP status to return"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+def read_request_body():
+    """Read the request body, decoding gzip or br content codings chunk by chunk
+
+    The decoded size is capped at MAX_REQUEST_BODY so that neither a chunked body nor a
+    small compressed body can grow without bound. The body is not cached on the request.
+    """
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    limit = MAX_REQUEST_BODY or sys.maxsize - 1
+    # json.loads accepts a bytearray, so the body is never copied into a second buffer
+    body = bytearray()
+    # Decoders stop one byte past the limit, so a chunk never expands beyond it
+    if encoding in ('', 'identity'):
+        decompress = lambda data: data
+        has_more = lambda: False
+    elif encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompress = lambda data: decompressor.decompress(data, limit + 1 - len(body))
+        has_more = lambda: bool(decompressor.unconsumed_tail)
+    elif encoding == 'br' and brotli is not None:
+        decompressor = brotli.Decompressor()
+        if not hasattr(decompressor, 'can_accept_more_data'):
+            # Older brotli releases cannot cap the output of one chunk
+            raise BodyDecodingError("br request bodies need brotli 1.2 or later, use gzip", 415)
+        decompress = lambda data: decompressor.process(data, output_buffer_limit=limit + 1 - len(body))
+        has_more = lambda: not decompressor.can_accept_more_data()
+    else:
+        raise BodyDecodingError(f"Unsupported Content-Encoding: {encoding}", 415)
+
+    try:
+        while True:
+            data = request.stream.read(DECOMPRESS_CHUNK_SIZE)
+            if not data:
+                break
+            body += decompress(data)
+            if len(body) > limit or has_more():
+                raise BodyDecodingError("Request body is too large", 413)
+    except (zlib.error, getattr(brotli, 'error', zlib.error)) as e:
+        raise BodyDecodingError(f"Failed to decode {encoding} request body: {str(e)}", 400)
+    return body
+
+def load_limits_settings():
+    """Load chat completion body limits from the server section of the configuration"""
+    global MAX_REQUEST_BODY, STREAM_UPLOAD_THRESHOLD
+    if not MULTI_BACKEND_CONFIG:
+        return
+    server = MULTI_BACKEND_CONFIG.get('server') or {}
+    limits = server.get('limits') or {}
+    max_request_mb = limits.get('max_request_mb')
+    legacy_max_request_mb = (server.get('compression') or {}).get('max_request_mb')
+    if legacy_max_request_mb is not None:
+        logger.warning("server.compression.max_request_mb is deprecated, use server.limits.max_request_mb")
+        if max_request_mb is None:
+            max_request_mb = legacy_max_request_mb
+    if max_request_mb is not None:
+        MAX_REQUEST_BODY = int(float(max_request_mb) * 1024 * 1024)
+    STREAM_UPLOAD_THRESHOLD = int(limits.get('stream_upload_kb', STREAM_UPLOAD_THRESHOLD // 1024)) * 1024
+
+def track_buffered(nbytes):
+    """Count bytes of request or response bodies held in memory for the current request
+
+    The counts are the sizes of the buffers the proxy allocates, an estimate rather than a measurement.
+    """
+    total = g.get('buffered_bytes', 0) + nbytes
+    g.buffered_bytes = total
+    trace_attribute('buffered_bytes', total)
+
+@app.teardown_request
+def record_request_memory(exc):
+    """Keep the bytes buffered by each request for /admin/stats"""
+    total = g.pop('buffered_bytes', None)
+    if total is not None:
+        REQUEST_MEMORY_SAMPLES.append(total)
+
+def iter_json_body(obj, chunk_size=PASSTHROUGH_CHUNK_SIZE):
+    """Serialize a request body in chunks so it is never held as one JSON string"""
+    pieces = []
+    size = 0
+    for piece in json.JSONEncoder(allow_nan=False).iterencode(obj):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(pieces).encode('utf-8')
+            pieces = []
+            size = 0
+    if pieces:
+        yield ''.join(pieces).encode('utf-8')
+
+def parse_usage_tail(tail):
+    """Parse the usage object from the last bytes of a completion response, or None"""
+    match = None
+    for match in USAGE_FIELD_PATTERN.finditer(tail):
+        pass
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except ValueError:
+        return None
+
+def iter_rewritten_completion(response, custom_model_id, deadline=None, started=None):
+    """Forward a non-streaming completion as it arrives, replacing only its top-level model
+
+    Only the leading bytes are held until the model field is found, plus the last
+    few kilobytes to read usage from, instead of parsing and re-serializing the body.
+    """
+    prefix = b''
+    tail = b''
+    started = started or time.monotonic()
+    try:
+        for chunk in response.iter_content(chunk_size=PASSTHROUGH_CHUNK_SIZE):
+            if prefix is not None:
+                prefix += chunk
+                match = find_top_level_model(prefix)
+                if match is None and len(prefix) < PASSTHROUGH_PEEK_SIZE:
+                    continue
+                if match is not None:
+                    replacement = json.dumps(custom_model_id).encode('utf-8')
+                    prefix = prefix[:match.start(1) - 1] + replacement + prefix[match.end(1) + 1:]
+                chunk, prefix = prefix, None
+            tail = (tail + chunk)[-USAGE_TAIL_SIZE:]
+            yield chunk
+            if deadline is not None and time.monotonic() > deadline:
+                # Headers are already sent, so the body can only be cut short
+                logger.warning("Upstream response exceeded its total deadline, closing")
+                return
+        if prefix:
+            tail = prefix[-USAGE_TAIL_SIZE:]
+            yield prefix
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Upstream response body stalled or failed: {str(e)}")
+        return
+    finally:
+        response.close()
+        trace = g.get('trace')
+        if trace is not None:
+            trace.add_span('upstream_body', started, time.monotonic())
+    g.upstream_usage = parse_usage_tail(tail)
+    capture_set(
+        upstream_body_ms=round((time.monotonic() - started) * 1000, 3),
+        usage=g.upstream_usage
+    )
+
+def incremental_completion_response(response, custom_model_id, deadline=None, started=None):
+    """Stream a non-streaming upstream completion to the client, compressed on the fly if accepted"""
+    track_buffered(PASSTHROUGH_PEEK_SIZE + USAGE_TAIL_SIZE)
+    body = iter_rewritten_completion(response, custom_model_id, deadline, started)
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    length = response.headers.get('Content-Length')
+    small = length is not None and 'Content-Encoding' not in response.headers and int(length) < COMPRESSION_MIN_SIZE
+    if encoding is not None and not small:
+        body = compress_stream(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(stream_with_context(body), content_type='application/json', headers=headers)
+
 def debug_log(message):
     """Debug logging"""
     if DEBUG_MODE:
@@ -93,17 +592,306 @@ def debug_log(message):
             f.write(f"[{timestamp}] {message}\n")
         logger.debug(message)
 
-def load_multi_backend_config():
+class RequestTrace:
+    """Monotonic-clock spans for the sequential phases of one request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = os.urandom(16).hex()
+        self.start_wall = time.time()
+        self.start = time.monotonic()
+        self.last = self.start
+        self.end = None
+        self.spans = []
+        self.attributes = {}
+
+    def lap(self, name):
+        """Close a span covering the time since the previous lap"""
+        now = time.monotonic()
+        self.spans.append((name, self.last, now))
+        self.last = now
+
+    def add_span(self, name, start, end):
+        self.spans.append((name, start, end))
+        self.last = max(self.last, end)
+
+    def to_dict(self):
+        end = self.end or time.monotonic()
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start_time": datetime.fromtimestamp(self.start_wall).isoformat(timespec='milliseconds'),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+            "spans": [
+                {
+                    "name": name,
+                    "offset_ms": round((start - self.start) * 1000, 3),
+                    "duration_ms": round((stop - start) * 1000, 3)
+                }
+                for name, start, stop in self.spans
+            ]
+        }
+
+    def to_otlp(self):
+        """Render the trace in the OTLP/JSON span layout"""
+        end = self.end or time.monotonic()
+
+        def unix_nano(moment):
+            return str(int((self.start_wall + moment - self.start) * 1e9))
+
+        def attributes(values):
+            return [{"key": key, "value": {"stringValue": str(value)}} for key, value in values.items()]
+
+        root_id = os.urandom(8).hex()
+        spans = [{
+            "traceId": self.trace_id, "spanId": root_id, "name": self.name, "kind": 2,
+            "startTimeUnixNano": unix_nano(self.start), "endTimeUnixNano": unix_nano(end),
+            "attributes": attributes(self.attributes)
+        }]
+        for name, start, stop in self.spans:
+            spans.append({
+                "traceId": self.trace_id, "spanId": os.urandom(8).hex(), "parentSpanId": root_id,
+                "name": name, "kind": 1,
+                "startTimeUnixNano": unix_nano(start), "endTimeUnixNano": unix_nano(stop)
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": attributes({"service.name": "trae-proxy"})},
+            "scopeSpans": [{"scope": {"name": "trae_proxy"}, "spans": spans}]
+        }]}
+
+def trace_lap(name):
+    """Close a span of the current request's trace, if it is being traced"""
+    trace = g.get('trace')
+    if trace is not None:
+        trace.lap(name)
+
+def trace_attribute(key, value):
+    """Attach an attribute to the current request's trace, if it is being traced"""
+    trace = g.get('trace')
+    if trace is not None:
+        trace.attributes[key] = value
+
+def load_tracing_settings():
+    """Load tracing and admin settings from the server section of the configuration"""
+    global TRACING_ENABLED, TRACING_SLOW_THRESHOLD, TRACING_EXPORT_FILE, SLOW_REQUESTS, ADMIN_TOKEN
+    global ADMIN_ALLOW_LOOPBACK
+    if not MULTI_BACKEND_CONFIG:
+        return
+    server = MULTI_BACKEND_CONFIG.get('server') or {}
+    tracing = server.get('tracing') or {}
+    TRACING_ENABLED = bool(tracing.get('enabled', TRACING_ENABLED))
+    TRACING_SLOW_THRESHOLD = float(tracing.get('slow_threshold_ms', TRACING_SLOW_THRESHOLD * 1000)) / 1000
+    TRACING_EXPORT_FILE = tracing.get('export_file', TRACING_EXPORT_FILE)
+    SLOW_REQUESTS = deque(SLOW_REQUESTS, maxlen=int(tracing.get('ring_size', SLOW_REQUESTS.maxlen)))
+    ADMIN_TOKEN = server.get('admin_token', ADMIN_TOKEN)
+    ADMIN_ALLOW_LOOPBACK = bool(server.get('admin_allow_loopback', ADMIN_ALLOW_LOOPBACK))
+
+@app.before_request
+def start_request_trace():
+    """Start timing the request (admin endpoints and health probes are not traced)"""
+    if TRACING_ENABLED and not request.path.startswith('/admin/') and request.path != '/healthz':
+        g.trace = RequestTrace(f"{request.method} {request.path}")
+
+@app.after_request
+def record_response_status(response):
+    """Note the response status on the trace and capture before the body is sent"""
+    trace_attribute('http.status_code', response.status_code)
+    capture_set(status=response.status_code)
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_trace(exc):
+    """Keep traces of slow requests; runs after a streamed body has been fully sent"""
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+    trace.end = time.monotonic()
+    if trace.end - trace.start < TRACING_SLOW_THRESHOLD:
+        return
+    if exc is not None:
+        trace.attributes['error'] = str(exc)
+    SLOW_REQUESTS.append(trace)
+    if TRACING_EXPORT_FILE:
+        try:
+            line = json.dumps(trace.to_otlp(), separators=(',', ':'))
+            with TRACE_EXPORT_LOCK, open(TRACING_EXPORT_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except Exception as e:
+            logger.error(f"Failed to export trace: {str(e)}")
+
+def admin_authorized():
+    """Admin endpoints need the configured token, or a loopback client when explicitly allowed"""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), str(ADMIN_TOKEN))
+    return ADMIN_ALLOW_LOOPBACK and request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/admin/slow-requests', methods=['GET'])
+def slow_requests():
+    """List recent requests slower than the tracing threshold with their span breakdown"""
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    traces = [trace.to_dict() for trace in list(SLOW_REQUESTS)]
+    traces.reverse()
+    return jsonify({
+        "threshold_ms": TRACING_SLOW_THRESHOLD * 1000,
+        "count": len(traces),
+        "requests": traces
+    })
+
+def load_capture_settings():
+    """Load traffic capture settings from the server section of the configuration"""
+    global CAPTURE_ENABLED, CAPTURE_FILE
+    if not MULTI_BACKEND_CONFIG:
+        return
+    capture = (MULTI_BACKEND_CONFIG.get('server') or {}).get('capture') or {}
+    CAPTURE_ENABLED = bool(capture.get('enabled', CAPTURE_ENABLED))
+    CAPTURE_FILE = capture.get('file', CAPTURE_FILE)
+
+def capture_set(**fields):
+    """Add fields to the current request's capture record, if it is being captured"""
+    entry = g.get('capture')
+    if entry is not None:
+        entry.update(fields)
+
+def message_shapes(req_json):
+    """Role and content length of each message, without the content itself"""
+    shapes = []
+    for message in req_json.get('messages') or []:
+        if isinstance(message, dict):
+            content = message.get('content')
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False) if content is not None else ''
+            shapes.append([message.get('role'), len(content)])
+    return shapes
+
+@app.before_request
+def start_request_capture():
+    """Start a capture record for chat completion requests"""
+    if CAPTURE_ENABLED and request.path == '/v1/chat/completions':
+        g.capture = {"t": round(time.time(), 3), "path": request.path, "started": time.monotonic()}
+
+@app.teardown_request
+def finish_request_capture(exc):
+    """Append the finished capture record, after a streamed body has been fully sent"""
+    global CAPTURE_HANDLE
+    entry = g.pop('capture', None)
+    if entry is None:
+        return
+    entry['duration_ms'] = round((time.monotonic() - entry.pop('started')) * 1000, 3)
+    line = json.dumps(entry, separators=(',', ':'))
+    try:
+        with CAPTURE_LOCK:
+            if CAPTURE_HANDLE is None:
+                CAPTURE_HANDLE = open(CAPTURE_FILE, "a", encoding="utf-8", buffering=1)
+            CAPTURE_HANDLE.write(line + "\n")
+    except Exception as e:
+        logger.error(f"Failed to write capture record: {str(e)}")
+
+def sample_stacks(seconds, interval, exclude):
+    """Sample the stacks of all threads and count identical collapsed stacks"""
+    counts = {}
+    thread_names = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if len(thread_names) != threading.active_count():
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in exclude:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return counts
+
+@app.route('/admin/profile', methods=['GET'])
+def profile():
+    """Sample all threads for N seconds and return collapsed stacks for flame graph tools
+
+    Nothing is sampled outside of a call to this endpoint.
+    """
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), PROFILE_MAX_SECONDS)
+        interval = max(float(request.args.get('interval_ms', 10)), 1) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return jsonify({"error": "A profile is already running"}), 409
+    try:
+        logger.info(f"Sampling profiler running for {seconds}s every {interval * 1000:.0f}ms")
+        counts = sample_stacks(seconds, interval, {threading.get_ident()})
+    finally:
+        PROFILE_LOCK.release()
+
+    lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    filename = f"trae-proxy-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return Response(
+        "\n".join(lines) + "\n",
+        content_type='text/plain; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+def config_snapshot_path(config_file):
+    """Path of the JSON snapshot kept next to a YAML configuration file"""
+    directory, name = os.path.split(os.path.abspath(config_file))
+    return os.path.join(directory, f".{name}.snapshot.json")
+
+def read_config_file(config_file):
+    """Parse the YAML configuration, reusing a JSON snapshot of it while the file is unchanged
+
+    Loading the snapshot avoids importing and running PyYAML on every start.
+    """
+    stat = os.stat(config_file)
+    source = [stat.st_mtime_ns, stat.st_size]
+    snapshot_file = config_snapshot_path(config_file)
+    try:
+        with open(snapshot_file, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get('source') == source:
+            return snapshot['config']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    import yaml
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    # Only snapshot configurations that survive a JSON round trip unchanged
+    try:
+        data = json.dumps({"source": source, "config": config}, ensure_ascii=False)
+        if json.loads(data)['config'] == config:
+            # The snapshot holds API keys: readable by the owner only
+            temp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+            fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_file, snapshot_file)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug(f"Configuration snapshot not written: {str(e)}")
+    return config
+
+def load_multi_backend_config(config_file="config.yaml"):
     """Load multi-backend configuration"""
-    global MULTI_BACKEND_CONFIG
+    global MULTI_BACKEND_CONFIG, MODELS_RESPONSE
     try:
-        config_file = "config.yaml"
         if os.path.exists(config_file):
-            with open(config_file, 'r', encoding='utf-8') as f:
-                config = yaml.safe_load(f)
-                MULTI_BACKEND_CONFIG = config
-                logger.info(f"Loaded multi-backend configuration, total {len(config.get('apis', []))} API configs")
-                return True
+            config = read_config_file(config_file)
+            MULTI_BACKEND_CONFIG = config
+            # Precomputed responses derived from the configuration are rebuilt on next use
+            MODELS_RESPONSE = None
+            logger.info(f"Loaded multi-backend configuration, total {len(config.get('apis', []))} API configs")
+            return True
         else:
             logger.warning("Configuration file does not exist, using single backend mode")
             return False
@@ -111,36 +899,1772 @@ def load_multi_backend_config():
         logger.error(f"Failed to load multi-backend configuration: {str(e)}")
         return False
 
-def select_backend_by_model(requested_model):
-    """Select backend API based on requested model"""
+def load_routing_settings():
+    """Load routing settings from the server section of the configuration"""
+    global AFFINITY_MESSAGES, AFFINITY_PREFIX_CHARS, AFFINITY_LOAD_FACTOR, AFFINITY_VIRTUAL_NODES
+    global ROUTING_STRATEGY, EXPECTED_COMPLETION_TOKENS, LATENCY_SLO_MS, UNHEALTHY_AFTER, UNHEALTHY_COOLDOWN
+    global QUOTA_UTC_OFFSET_HOURS
+    if not MULTI_BACKEND_CONFIG:
+        return
+    routing = (MULTI_BACKEND_CONFIG.get('server') or {}).get('routing') or {}
+    AFFINITY_MESSAGES = int(routing.get('affinity_messages', AFFINITY_MESSAGES))
+    AFFINITY_PREFIX_CHARS = int(routing.get('affinity_prefix_chars', AFFINITY_PREFIX_CHARS))
+    AFFINITY_LOAD_FACTOR = float(routing.get('affinity_load_factor', AFFINITY_LOAD_FACTOR))
+    AFFINITY_VIRTUAL_NODES = int(routing.get('affinity_virtual_nodes', AFFINITY_VIRTUAL_NODES))
+    strategy = str(routing.get('strategy', ROUTING_STRATEGY)).lower()
+    if strategy in ('affinity', 'cost'):
+        ROUTING_STRATEGY = strategy
+    else:
+        logger.warning(f"Unknown routing strategy '{strategy}', using {ROUTING_STRATEGY}")
+    EXPECTED_COMPLETION_TOKENS = int(routing.get('expected_completion_tokens', EXPECTED_COMPLETION_TOKENS))
+    LATENCY_SLO_MS = routing.get('latency_slo_ms', LATENCY_SLO_MS)
+    UNHEALTHY_AFTER = int(routing.get('unhealthy_after', UNHEALTHY_AFTER))
+    UNHEALTHY_COOLDOWN = float(routing.get('unhealthy_cooldown', UNHEALTHY_COOLDOWN))
+    QUOTA_UTC_OFFSET_HOURS = float(routing.get('quota_utc_offset_hours', QUOTA_UTC_OFFSET_HOURS))
+    HASH_RINGS.clear()
+
+def prompt_prefix_hash(req_json):
+    """Hash the leading system messages and the first few other messages of a request"""
+    messages = (req_json or {}).get('messages')
+    if not isinstance(messages, list) or not messages:
+        return None
+    digest = hashlib.sha1()
+    remaining = AFFINITY_PREFIX_CHARS
+    others = 0
+    for message in messages:
+        if not isinstance(message, dict):
+            break
+        if message.get('role') != 'system':
+            if others >= AFFINITY_MESSAGES:
+                break
+            others += 1
+        content = message.get('content')
+        if not isinstance(content, str):
+            content = json.dumps(content, sort_keys=True, ensure_ascii=False)
+        # Providers cache by prefix, so the first characters identify the conversation
+        text = f"{message.get('role')}\0{content[:remaining]}\0"
+        digest.update(text.encode('utf-8'))
+        remaining -= len(content)
+        if remaining <= 0:
+            break
+    return int.from_bytes(digest.digest()[:8], 'big')
+
+def get_hash_ring(candidates):
+    """Get the consistent hash ring of (point, candidate index) for a group of backends"""
+    names = tuple(api.get('name', '') for api in candidates)
+    ring = HASH_RINGS.get(names)
+    if ring is None:
+        ring = []
+        for index, name in enumerate(names):
+            for replica in range(AFFINITY_VIRTUAL_NODES):
+                point = int.from_bytes(hashlib.sha1(f"{name}#{replica}".encode('utf-8')).digest()[:8], 'big')
+                ring.append((point, index))
+        ring.sort()
+        HASH_RINGS[names] = ring
+    return ring
+
+def select_by_prefix_affinity(candidates, prefix_hash):
+    """Consistent hashing with bounded load: the first backend on the ring below its load cap"""
+    with BACKEND_INFLIGHT_LOCK:
+        loads = [BACKEND_INFLIGHT.get(api.get('name'), 0) for api in candidates]
+    capacity = math.ceil(AFFINITY_LOAD_FACTOR * (sum(loads) + 1) / len(candidates))
+    ring = get_hash_ring(candidates)
+    start = bisect.bisect_left(ring, (prefix_hash, -1))
+    for i in range(len(ring)):
+        index = ring[(start + i) % len(ring)][1]
+        if loads[index] < capacity:
+            return candidates[index]
+    return candidates[loads.index(min(loads))]
+
+def begin_backend_request(api):
+    """Count an upstream request against a backend until the request context is torn down"""
+    name = api.get('name') if api else None
+    if name is None:
+        return
+    with BACKEND_INFLIGHT_LOCK:
+        BACKEND_INFLIGHT[name] = BACKEND_INFLIGHT.get(name, 0) + 1
+    g.inflight_backend = name
+    record_backend_stat(name, 'requests')
+
+@app.teardown_request
+def end_backend_request(exc):
+    """Release the in-flight slot taken by begin_backend_request (after streaming completes)"""
+    name = g.pop('inflight_backend', None)
+    if name is not None:
+        with BACKEND_INFLIGHT_LOCK:
+            BACKEND_INFLIGHT[name] = max(BACKEND_INFLIGHT.get(name, 1) - 1, 0)
+        status = g.get('response_status', 200)
+        if exc is not None or status >= 500:
+            record_backend_stat(name, 'errors')
+        record_backend_health(name, exc is None and status < 500 and status != 429)
+
+def record_backend_health(name, ok):
+    """Count consecutive failed (5xx, 429 or broken) upstream requests of a backend in the shared state
+
+    The count expires unhealthy_cooldown seconds after the last failure, and a success resets it
+    by subtracting the cached count. Both are batched increments, so no request waits on the store.
+    """
+    if BACKEND_STATS is None:
+        return
+    key = f"health:{name}:failures"
+    if ok:
+        failures = BACKEND_STATS.get(key, max_age=SHARED_STATE_FLUSH_INTERVAL)
+        if failures:
+            BACKEND_STATS.add(key, -failures, ttl=UNHEALTHY_COOLDOWN)
+    else:
+        BACKEND_STATS.add(key, 1, ttl=UNHEALTHY_COOLDOWN)
+
+def backend_healthy(api):
+    """Whether a backend has fewer than unhealthy_after consecutive failures across all workers"""
+    if BACKEND_STATS is None:
+        return True
+    return BACKEND_STATS.get(f"health:{api.get('name')}:failures", max_age=SHARED_STATE_FLUSH_INTERVAL) < UNHEALTHY_AFTER
+
+class RoutingError(Exception):
+    """No backend can take the request; carries the HTTP status to return to the client"""
+
+    def __init__(self, message, status_code, code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.retry_after = retry_after
+
+def routing_error_response(e):
+    """OpenAI-style error response for a request no backend can take"""
+    logger.warning(f"Request rejected: {str(e)}")
+    error_type = "rate_limit_error" if e.status_code == 429 else "invalid_request_error"
+    response = jsonify({"error": {"message": str(e), "type": error_type, "code": e.code}})
+    response.status_code = e.status_code
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def estimate_text_tokens(text):
+    """Estimate the token count of a string without tokenizing it
+
+    ASCII text averages about four characters per token, while CJK and other
+    multi-byte characters are close to one token each. The number of multi-byte
+    characters is derived from the UTF-8 length, which is computed in C.
+    """
+    if not text:
+        return 0
+    extra_bytes = len(text.encode('utf-8', 'surrogatepass')) - len(text)
+    wide_chars = extra_bytes // 2
+    return (len(text) - wide_chars + 3) // 4 + wide_chars
+
+def estimate_request_tokens(req_json):
+    """Estimate prompt tokens of a chat request message by message, plus the requested completion"""
+    messages = req_json.get('messages') or []
+    # Plain string contents are batched into one encode call; role and separators cost ~4 tokens each
+    texts = []
+    tokens = 4 * len(messages)
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        content = message.get('content')
+        if content.__class__ is str:
+            texts.append(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and isinstance(part.get('text'), str):
+                    texts.append(part['text'])
+                elif part is not None:
+                    texts.append(json.dumps(part, ensure_ascii=False))
+        if message.get('tool_calls') or message.get('function_call'):
+            texts.append(json.dumps(message.get('tool_calls') or message.get('function_call'), ensure_ascii=False))
+    if req_json.get('tools'):
+        texts.append(json.dumps(req_json['tools'], ensure_ascii=False))
+    return tokens + estimate_text_tokens('\n'.join(texts))
+
+def load_compaction_settings():
+    """Load message compaction settings from the server section of the configuration"""
+    global COMPACTION_ENABLED, COMPACTION_MIN_CHARS, COMPACTION_DUPLICATES, COMPACTION_STALE_AFTER
+    global COMPACTION_STALE_BATCH, COMPACTION_STALE_ROLES, COMPACTION_KEEP_HEAD, COMPACTION_KEEP_TAIL
+    global COMPACTION_MAX_SESSIONS, COMPACTION_SESSION_TTL
+    if not MULTI_BACKEND_CONFIG:
+        return
+    compaction = (MULTI_BACKEND_CONFIG.get('server') or {}).get('compaction') or {}
+    COMPACTION_ENABLED = bool(compaction.get('enabled', COMPACTION_ENABLED))
+    COMPACTION_MIN_CHARS = max(int(compaction.get('min_chars', COMPACTION_MIN_CHARS)), 1)
+    duplicates = str(compaction.get('duplicates', COMPACTION_DUPLICATES)).lower()
+    if duplicates in ('reference', 'truncate', 'keep'):
+        COMPACTION_DUPLICATES = duplicates
+    else:
+        logger.warning(f"Unknown compaction duplicates policy '{duplicates}', using {COMPACTION_DUPLICATES}")
+    COMPACTION_STALE_AFTER = int(compaction.get('stale_after_requests', COMPACTION_STALE_AFTER))
+    COMPACTION_STALE_BATCH = max(int(compaction.get('stale_batch_requests', COMPACTION_STALE_BATCH)), 1)
+    COMPACTION_STALE_ROLES = tuple(compaction.get('stale_roles', COMPACTION_STALE_ROLES))
+    COMPACTION_KEEP_HEAD = int(compaction.get('keep_head_chars', COMPACTION_KEEP_HEAD))
+    COMPACTION_KEEP_TAIL = int(compaction.get('keep_tail_chars', COMPACTION_KEEP_TAIL))
+    COMPACTION_MAX_SESSIONS = int(compaction.get('max_sessions', COMPACTION_MAX_SESSIONS))
+    COMPACTION_SESSION_TTL = float(compaction.get('session_ttl', COMPACTION_SESSION_TTL))
+
+class CompactionSession:
+    """Messages a client session sent before, with the request each first appeared in"""
+
+    def __init__(self):
+        self.requests = 0
+        # (message hash, request number) for each message of the last request
+        self.messages = []
+        # Messages first sent in this request or earlier are stale
+        self.watermark = 0
+        self.last_used = time.monotonic()
+
+def get_compaction_session(key):
+    """Get or create a session's compaction state, evicting idle and least recently used sessions"""
+    now = time.monotonic()
+    session = COMPACTION_SESSIONS.pop(key, None)
+    if session is None or now - session.last_used > COMPACTION_SESSION_TTL:
+        session = CompactionSession()
+    session.last_used = now
+    COMPACTION_SESSIONS[key] = session
+    while len(COMPACTION_SESSIONS) > 1:
+        oldest = next(iter(COMPACTION_SESSIONS.values()))
+        if len(COMPACTION_SESSIONS) <= COMPACTION_MAX_SESSIONS and now - oldest.last_used <= COMPACTION_SESSION_TTL:
+            break
+        COMPACTION_SESSIONS.popitem(last=False)
+    return session
+
+def compaction_session_key(req_json):
+    """Identify a client session by its credentials and prompt prefix"""
+    prefix_hash = prompt_prefix_hash(req_json)
+    if prefix_hash is None:
+        return None
+    return request.headers.get('Authorization', ''), prefix_hash
+
+def message_hash(message):
+    """Hash of a message's role, content and tool call ID"""
+    if not isinstance(message, dict):
+        return hash(repr(message))
+    content = message.get('content')
+    if content is not None and not isinstance(content, str):
+        content = json.dumps(content, sort_keys=True, ensure_ascii=False)
+    return hash((message.get('role'), content, message.get('tool_call_id')))
+
+def truncate_block(text):
+    """Keep the head and tail of a text, noting how much was cut"""
+    omitted = len(text) - COMPACTION_KEEP_HEAD - COMPACTION_KEEP_TAIL
+    if omitted <= 0:
+        return text
+    return f"{text[:COMPACTION_KEEP_HEAD]}\n[... {omitted} characters omitted ...]\n{text[len(text) - COMPACTION_KEEP_TAIL:]}"
+
+def count_saving(original, replacement, stats, field):
+    """Add the bytes and estimated tokens a replacement saves to the stats"""
+    stats[field] += 1
+    stats['bytes_saved'] += len(original.encode('utf-8', 'surrogatepass')) - len(replacement.encode('utf-8', 'surrogatepass'))
+    stats['tokens_saved'] += estimate_text_tokens(original) - estimate_text_tokens(replacement)
+
+def compact_block(block, index, first_seen, stats):
+    """Replace a block already seen earlier in the request according to the duplicates policy"""
+    first = first_seen.get(block)
+    if first is None:
+        first_seen[block] = index
+        return block
+    if COMPACTION_DUPLICATES == 'reference':
+        replacement = f"[{len(block)} characters omitted: identical to the content of message {first + 1} above]"
+    elif COMPACTION_DUPLICATES == 'truncate':
+        replacement = truncate_block(block)
+    else:
+        return block
+    if replacement is not block:
+        count_saving(block, replacement, stats, 'duplicate_blocks')
+    return replacement
+
+def compact_text(text, index, role, stale, first_seen, stats):
+    """Compact one message text as a whole, or else the large fenced code blocks inside it"""
+    if len(text) < COMPACTION_MIN_CHARS:
+        return text
+    if role == 'system':
+        # System prompts are never changed, but later copies may point back to them
+        first_seen.setdefault(text, index)
+        return text
+    if stale:
+        # Repeats of a stale block point back to its truncated first copy
+        first = first_seen.setdefault(('stale', text), index)
+        if first != index:
+            replacement = f"[{len(text)} characters omitted: identical to the content of message {first + 1} above]"
+        else:
+            replacement = truncate_block(text)
+        if replacement is not text:
+            count_saving(text, replacement, stats, 'stale_blocks')
+        return replacement
+    compacted = compact_block(text, index, first_seen, stats)
+    if compacted is not text or '```' not in text:
+        return compacted
+    # File contents pasted into otherwise different messages
+    pieces = []
+    last = 0
+    for match in FENCED_BLOCK_PATTERN.finditer(text):
+        if match.end() - match.start() < COMPACTION_MIN_CHARS:
+            continue
+        block = match.group(0)
+        compacted = compact_block(block, index, first_seen, stats)
+        if compacted is not block:
+            pieces.append(text[last:match.start()])
+            pieces.append(compacted)
+            last = match.end()
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+def compact_messages(req_json, session_key=None):
+    """Compact repeated and stale large blocks of a chat request's messages in place
+
+    Later copies of a block seen earlier in the request are replaced or truncated.
+    Within a session, messages of the stale roles first sent stale_after_requests
+    requests ago are truncated. The stale point only advances every
+    stale_batch_requests requests, and a message is compacted the same way in
+    every later request, so the provider's prompt cache is rarely invalidated.
+    Returns the request's stats, or None when it has no messages.
+    """
+    messages = req_json.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return None
+    hashes = [message_hash(message) for message in messages]
+    appeared = [0] * len(messages)
+    matched = 0
+    watermark = 0
+    if session_key is not None:
+        with COMPACTION_LOCK:
+            session = get_compaction_session(session_key)
+            session.requests += 1
+            known = session.messages
+            limit = min(len(known), len(hashes))
+            while matched < limit and known[matched][0] == hashes[matched]:
+                matched += 1
+            session.messages = known[:matched] + [(digest, session.requests) for digest in hashes[matched:]]
+            if COMPACTION_STALE_AFTER > 0:
+                if session.requests - COMPACTION_STALE_AFTER - session.watermark >= COMPACTION_STALE_BATCH:
+                    session.watermark = session.requests - COMPACTION_STALE_AFTER
+                watermark = session.watermark
+            appeared = [number for _, number in session.messages]
+
+    stats = dict.fromkeys(COMPACTION_FIELDS[2:], 0)
+    first_seen = {}
+    last = len(messages) - 1
+    for index, message in enumerate(messages):
+        if not isinstance(message, dict):
+            continue
+        role = message.get('role')
+        stale = 0 < appeared[index] <= watermark and role in COMPACTION_STALE_ROLES and index < last
+        content = message.get('content')
+        if isinstance(content, str):
+            if index < matched:
+                stats['resent_bytes'] += len(content.encode('utf-8', 'surrogatepass'))
+            message['content'] = compact_text(content, index, role, stale, first_seen, stats)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and isinstance(part.get('text'), str):
+                    if index < matched:
+                        stats['resent_bytes'] += len(part['text'].encode('utf-8', 'surrogatepass'))
+                    part['text'] = compact_text(part['text'], index, role, stale, first_seen, stats)
+
+    if BACKEND_STATS is not None:
+        BACKEND_STATS.add('compaction:requests')
+        if stats['bytes_saved']:
+            BACKEND_STATS.add('compaction:compacted_requests')
+        for field, amount in stats.items():
+            if amount:
+                BACKEND_STATS.add(f"compaction:{field}", amount)
+    return stats
+
+class TokenBucket:
+    """Tokens-per-minute budget refilled continuously"""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = float(tokens_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def available(self, tokens):
+        with self.lock:
+            self._refill()
+            # Requests larger than the whole budget are admitted once the bucket is full
+            return self.tokens >= min(tokens, self.capacity)
+
+    def consume(self, tokens):
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+
+    def retry_after(self, tokens):
+        with self.lock:
+            self._refill()
+            return max(math.ceil((min(tokens, self.capacity) - self.tokens) * 60 / self.capacity), 1)
+
+def get_tpm_bucket(api):
+    """Get the token bucket of a backend with a tpm_limit, or None"""
+    limit = api.get('tpm_limit')
+    if not limit:
+        return None
+    name = api.get('name', '')
+    bucket = TPM_BUCKETS.get(name)
+    if bucket is None or bucket.capacity != float(limit):
+        if SHARED_STATE is None or SHARED_STATE.name == 'local':
+            bucket = TokenBucket(limit)
+        else:
+            bucket = LeasedTokenBudget(name, limit, SHARED_STATE)
+        TPM_BUCKETS[name] = bucket
+    return bucket
+
+def backend_fits_context(api, tokens):
+    """Whether the request fits the backend's max_context (backends without one accept anything)"""
+    max_context = api.get('max_context')
+    return not max_context or tokens <= int(max_context)
+
+def filter_backends_by_capacity(candidates, tokens):
+    """Drop backends whose context window or TPM budget cannot take the request"""
+    fitting = [api for api in candidates if backend_fits_context(api, tokens)]
+    if not fitting:
+        return [], None
+    with TPM_BUCKETS_LOCK:
+        buckets = [(api, get_tpm_bucket(api)) for api in fitting]
+    # Buckets lock themselves, so a lease from the shared store never holds up other backends
+    allowed = []
+    retry_after = None
+    for api, bucket in buckets:
+        if bucket is None or bucket.available(tokens):
+            allowed.append(api)
+        else:
+            wait = bucket.retry_after(tokens)
+            retry_after = wait if retry_after is None else min(retry_after, wait)
+    return allowed, retry_after
+
+def quota_day():
+    """Current quota day as YYYYMMDD, in the timezone of server.routing.quota_utc_offset_hours"""
+    return time.strftime('%Y%m%d', time.gmtime(time.time() + QUOTA_UTC_OFFSET_HOURS * 3600))
+
+def seconds_until_quota_reset():
+    """Seconds until daily token quotas start over"""
+    return max(int(86400 - (time.time() + QUOTA_UTC_OFFSET_HOURS * 3600) % 86400), 1)
+
+def backend_prices(api):
+    """Input, output and cached-input prices of a backend per million tokens"""
+    price = api.get('price') or {}
+    input_price = float(price.get('input', 0))
+    return input_price, float(price.get('output', 0)), float(price.get('cached_input', input_price))
+
+def daily_usage(name, field, max_age=None):
+    """Tokens or spend_micros charged to a backend so far in the current quota day
+
+    Routing uses the value cached by the stats flush; max_age=0 reads the store directly.
+    """
+    if BACKEND_STATS is None:
+        return 0
+    if max_age is None:
+        max_age = SHARED_STATE_FLUSH_INTERVAL
+    return BACKEND_STATS.get(f"daily:{name}:{quota_day()}:{field}", max_age=max_age)
+
+def backend_within_quota(api, tokens):
+    """Whether a backend's daily_token_quota leaves room for the request (fails open without state)"""
+    quota = api.get('daily_token_quota')
+    if not quota:
+        return True
+    return daily_usage(api.get('name'), 'tokens') + tokens <= int(quota)
+
+def backend_within_slo(api):
+    """Whether a backend's recent p90 time to first byte meets its latency SLO (unknown counts as met)"""
+    slo = api.get('latency_slo_ms', LATENCY_SLO_MS)
+    if not slo:
+        return True
+    p90 = latency_percentile(api.get('name'), 'ttfb', 0.9)
+    return p90 is None or p90 * 1000 <= float(slo)
+
+def equivalent_backends(candidates, active_apis):
+    """Add the active backends that share an equivalence group with the candidates"""
+    groups = {api.get('group') for api in candidates if api.get('group')}
+    if not groups:
+        return candidates
+    return candidates + [api for api in active_apis if api.get('group') in groups and api not in candidates]
+
+def is_equivalent_model(api, requested_model):
+    """Whether a backend was picked for requested_model through its equivalence group"""
+    group = api.get('group')
+    if not group or api.get('custom_model_id') == requested_model:
+        return False
+    return any(
+        other.get('group') == group and other.get('custom_model_id') == requested_model
+        for other in (MULTI_BACKEND_CONFIG or {}).get('apis', []) if other.get('active', False)
+    )
+
+def filter_backends_by_quota(candidates, tokens, requested_model):
+    """Drop backends whose daily token quota is used up, raising RoutingError if none remain"""
+    allowed = [api for api in candidates if backend_within_quota(api, tokens)]
+    if candidates and not allowed:
+        raise RoutingError(
+            f"Daily token quota exhausted for {requested_model}", 429, 'insufficient_quota',
+            seconds_until_quota_reset()
+        )
+    return allowed
+
+def select_cheapest_backends(candidates, req_json, context_tokens):
+    """Keep the healthy, in-SLO candidates with the lowest expected cost for the request
+
+    Unhealthy or slow backends are only avoided while others remain, so a request
+    is never rejected for them. Candidates of equal cost are all kept.
+    """
+    candidates = [api for api in candidates if backend_healthy(api)] or candidates
+    candidates = [api for api in candidates if backend_within_slo(api)] or candidates
+    max_tokens = (req_json or {}).get('max_tokens') or (req_json or {}).get('max_completion_tokens')
+    if isinstance(max_tokens, int) and max_tokens > 0:
+        # context_tokens includes max_tokens, which only bounds the completion
+        prompt_tokens = max((context_tokens or 0) - max_tokens, 0)
+        completion_tokens = min(max_tokens, EXPECTED_COMPLETION_TOKENS)
+    else:
+        prompt_tokens = context_tokens or 0
+        completion_tokens = EXPECTED_COMPLETION_TOKENS
+    costs = []
+    for api in candidates:
+        input_price, output_price, _ = backend_prices(api)
+        costs.append(prompt_tokens * input_price + completion_tokens * output_price)
+    cheapest = min(costs)
+    return [api for api, cost in zip(candidates, costs) if cost <= cheapest]
+
+def select_backend_by_model(requested_model, req_json=None, prompt_tokens=None):
+    """Select backend API based on requested model
+
+    When prompt_tokens is given, backends whose max_context or tpm_limit cannot
+    take the request are skipped, and RoutingError is raised if none remain.
+    Backends over their daily_token_quota are always skipped. With the cost
+    strategy, the cheapest backend of the model's equivalence group is used.
+    """
     if not MULTI_BACKEND_CONFIG:
         return None
 
     apis = MULTI_BACKEND_CONFIG.get('apis', [])
+    active_apis = [api for api in apis if api.get('active', False)]
 
     # First try exact match by model ID
-    for api in apis:
-        if api.get('active', False) and api.get('custom_model_id') == requested_model:
-            logger.info(f"Matched backend by model ID: {api['name']} -> {api['endpoint']}")
-            return api
-
-    # If no exact match, use first active API
-    for api in apis:
-        if api.get('active', False):
-            logger.info(f"Using default active backend: {api['name']} -> {api['endpoint']}")
-            return api
-
-    # If none are active, use the first one
-    if apis:
+    candidates = [api for api in active_apis if api.get('custom_model_id') == requested_model]
+    if ROUTING_STRATEGY == 'cost' and candidates:
+        # Backends of equivalent models may serve the request for less
+        candidates = equivalent_backends(candidates, active_apis)
+
+    if prompt_tokens is not None and active_apis:
+        allowed, retry_after = filter_backends_by_capacity(candidates, prompt_tokens)
+        if candidates and not allowed and retry_after is None:
+            # The requested model's context is too small: use an equivalent backend that fits
+            equivalents = [api for api in equivalent_backends(candidates, active_apis) if api not in candidates]
+            allowed, retry_after = filter_backends_by_capacity(equivalents, prompt_tokens)
+            if allowed:
+                logger.warning(f"Request of ~{prompt_tokens} tokens exceeds max_context of {requested_model}, rerouting")
+        elif not candidates:
+            allowed, retry_after = filter_backends_by_capacity(active_apis, prompt_tokens)
+            allowed = filter_backends_by_quota(allowed, prompt_tokens, requested_model or 'the default backend')
+            if allowed:
+                api = allowed[0]
+                logger.info(f"Using default active backend: {api['name']} -> {api['endpoint']}")
+                consume_backend_tokens(api, prompt_tokens)
+                return api
+
+        if not allowed:
+            if retry_after is not None:
+                raise RoutingError(
+                    f"Token rate limit reached for {requested_model}", 429, 'rate_limit_exceeded', retry_after
+                )
+            raise RoutingError(
+                f"Request of about {prompt_tokens} tokens exceeds the context window of {requested_model or 'every configured backend'}",
+                400, 'context_length_exceeded'
+            )
+        candidates = allowed
+
+    candidates = filter_backends_by_quota(candidates, prompt_tokens or 0, requested_model)
+    if ROUTING_STRATEGY == 'cost' and len(candidates) > 1:
+        candidates = select_cheapest_backends(candidates, req_json, prompt_tokens)
+
+    if len(candidates) > 1:
+        # Several backends or keys serve this model: keep a conversation on the same one
+        # so provider-side prompt caches keep hitting
+        prefix_hash = prompt_prefix_hash(req_json)
+        if prefix_hash is not None:
+            api = select_by_prefix_affinity(candidates, prefix_hash)
+            logger.info(f"Matched backend by prompt prefix affinity: {api['name']} -> {api['endpoint']}")
+        else:
+            with BACKEND_INFLIGHT_LOCK:
+                api = min(candidates, key=lambda candidate: BACKEND_INFLIGHT.get(candidate.get('name'), 0))
+            logger.info(f"Matched least loaded backend by model ID: {api['name']} -> {api['endpoint']}")
+        consume_backend_tokens(api, prompt_tokens)
+        return api
+    if candidates:
+        api = candidates[0]
+        logger.info(f"Matched backend by model ID: {api['name']} -> {api['endpoint']}")
+        consume_backend_tokens(api, prompt_tokens)
+        return api
+
+    # If no exact match, use the first active API with quota left, or the first one if none are active
+    defaults = filter_backends_by_quota(active_apis or apis[:1], prompt_tokens or 0, requested_model or 'the default backend')
+    if defaults and active_apis:
+        api = defaults[0]
+        logger.info(f"Using default active backend: {api['name']} -> {api['endpoint']}")
+        return api
+    if defaults:
         logger.warning(f"No active API configuration, using first one: {apis[0]['name']}")
         return apis[0]
 
     return None
 
-def generate_stream(response):
-    """Generate streaming response"""
-    for chunk in response.iter_content(chunk_size=None):
-        yield chunk
+def consume_backend_tokens(api, tokens):
+    """Charge estimated tokens against the backend's TPM budget"""
+    if tokens is None:
+        return
+    with TPM_BUCKETS_LOCK:
+        bucket = get_tpm_bucket(api)
+    if bucket is not None:
+        bucket.consume(tokens)
+    record_backend_stat(api.get('name'), 'prompt_tokens', tokens)
+
+class StateStoreError(Exception):
+    """The shared-state backend is unreachable, full or returned an error
+
+    sent tells whether the failed commands reached the store; applied holds the keys of
+    a batch that were (or may have been) added before the error and must not be added again.
+    """
+
+    def __init__(self, message, sent=False, applied=()):
+        super().__init__(message)
+        self.sent = sent
+        self.applied = set(applied)
+
+class LocalStateStore:
+    """Integer counters kept in this process"""
+
+    name = 'local'
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _prune(self, now):
+        for key in [key for key, (_, expires) in self.values.items() if expires and expires <= now]:
+            del self.values[key]
+
+    def incr(self, key, amount, ttl=None):
+        """Add amount to a counter and return the new value; ttl (seconds) refreshes its expiry"""
+        now = time.time()
+        with self.lock:
+            value, expires = self.values.get(key, (0, 0))
+            if expires and expires <= now:
+                value, expires = 0, 0
+            if key not in self.values and len(self.values) >= 1024:
+                self._prune(now)
+            self.values[key] = (value + amount, now + ttl if ttl else expires)
+            return value + amount
+
+    def incr_many(self, deltas):
+        for key, amount in deltas.items():
+            self.incr(key, amount)
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (0, 0))
+            return 0 if expires and expires <= time.time() else value
+
+class SharedMemoryStateStore:
+    """Integer counters in a memory-mapped open-addressing table shared by the workers of one host
+
+    Updates serialize on an exclusive lock of the file, like the completion cache index.
+    """
+
+    MAGIC = b'TRAESST1'
+    HEADER = struct.Struct('<8sI')       # magic, slot count
+    HEADER_SIZE = 64
+    SLOT = struct.Struct('<Qdq')         # key hash (0 = empty), expiry (epoch, 0 = never), value
+    MAX_PROBES = 32
+
+    name = 'shm'
+
+    def __init__(self, path, slots):
+        if fcntl is None:
+            raise StateStoreError("The shm shared state backend needs fcntl file locking")
+        self.path = path
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        size = self.HEADER_SIZE + slots * self.SLOT.size
+        with self._file_lock():
+            self.file.seek(0)
+            header = self.file.read(self.HEADER.size)
+            valid = len(header) == self.HEADER.size and self.HEADER.unpack(header) == (self.MAGIC, slots)
+            if not valid or os.fstat(self.file.fileno()).st_size != size:
+                self.file.truncate(0)
+                self.file.truncate(size)
+                self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), size)
+            if not valid:
+                self.HEADER.pack_into(self.map, 0, self.MAGIC, slots)
+
+    @contextmanager
+    def _file_lock(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key_hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+    def _find(self, key_hash, now, create):
+        """Offset of the key's slot; with create, claim an empty or expired slot for it"""
+        free = None
+        start = key_hash % self.slots
+        for i in range(self.MAX_PROBES):
+            offset = self.HEADER_SIZE + ((start + i) % self.slots) * self.SLOT.size
+            slot_hash, expires, _ = self.SLOT.unpack_from(self.map, offset)
+            if slot_hash == key_hash:
+                return offset
+            if slot_hash == 0:
+                # Slots are never emptied, so an empty slot ends the probe sequence
+                if free is None:
+                    free = offset
+                break
+            if free is None and expires and expires <= now:
+                free = offset
+        if not create:
+            return None
+        if free is None:
+            raise StateStoreError(f"Shared state table {self.path} is full")
+        self.SLOT.pack_into(self.map, free, key_hash, 0, 0)
+        return free
+
+    def _incr(self, key, amount, ttl, now):
+        key_hash = self._key_hash(key)
+        offset = self._find(key_hash, now, True)
+        _, expires, value = self.SLOT.unpack_from(self.map, offset)
+        if expires and expires <= now:
+            value, expires = 0, 0
+        value += amount
+        self.SLOT.pack_into(self.map, offset, key_hash, now + ttl if ttl else expires, value)
+        return value
+
+    def incr(self, key, amount, ttl=None):
+        with self.lock, self._file_lock():
+            return self._incr(key, amount, ttl, time.time())
+
+    def incr_many(self, deltas):
+        with self.lock, self._file_lock():
+            now = time.time()
+            applied = []
+            for key, amount in deltas.items():
+                try:
+                    self._incr(key, amount, None, now)
+                except StateStoreError as e:
+                    # Keys before the full table are already counted
+                    e.applied = set(applied)
+                    raise
+                applied.append(key)
+
+    def get(self, key):
+        with self.lock:
+            now = time.time()
+            offset = self._find(self._key_hash(key), now, False)
+            if offset is None:
+                return 0
+            _, expires, value = self.SLOT.unpack_from(self.map, offset)
+            return 0 if expires and expires <= now else value
+
+class RedisStateStore:
+    """Integer counters in a Redis-compatible server, spoken to with a minimal pipelined RESP client"""
+
+    PREFIX = 'trae_proxy:'
+    # Commands that may be resent when the reply is lost
+    IDEMPOTENT_COMMANDS = frozenset(('GET', 'PING', 'PEXPIRE'))
+
+    name = 'redis'
+
+    def __init__(self, url, timeout=1.0, retry_interval=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        # Monotonic time before which the server is not contacted after a failure
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+
+    @staticmethod
+    def _encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            data = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise StateStoreError("Connection closed by the shared state server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise StateStoreError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            return None if length < 0 else self.reader.read(length + 2)[:-2]
+        if kind == b'*':
+            return [self._read_reply() for _ in range(int(rest))]
+        raise StateStoreError(f"Unexpected reply from the shared state server: {line[:64]!r}")
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            self._pipeline(setup)
+
+    def _pipeline(self, commands):
+        self.sock.sendall(b''.join(self._encode(command) for command in commands))
+        return [self._read_reply() for _ in commands]
+
+    def _connection_alive(self):
+        """False when an idle connection has pending input, i.e. the server closed or reset it"""
+        try:
+            return not select.select([self.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+    def execute(self, commands):
+        """Send commands in one round trip
+
+        A stale connection is replaced before sending. Once sent, a pipeline is only resent
+        if all its commands are idempotent: the server may already have applied an INCRBY.
+        After a failure the server is skipped for retry_interval seconds, so callers fail
+        fast instead of each waiting for the timeout.
+        """
+        resendable = all(command[0] in self.IDEMPOTENT_COMMANDS for command in commands)
+        with self.lock:
+            if time.monotonic() < self.retry_at:
+                raise StateStoreError(f"Shared state server {self.host}:{self.port} is unavailable, "
+                                      f"retrying within {self.retry_interval:g}s")
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self.sock is not None and not self._connection_alive():
+                        self.close()
+                    if self.sock is None:
+                        self._connect()
+                    sent = True
+                    return self._pipeline(commands)
+                except (OSError, ValueError, StateStoreError) as e:
+                    # A failed pipeline leaves unread replies behind: drop the connection
+                    self.close()
+                    # Only a connection closed under us is worth a second attempt, not a timeout
+                    if attempt or isinstance(e, socket.timeout) or (sent and not resendable):
+                        self.retry_at = time.monotonic() + self.retry_interval
+                        raise StateStoreError(f"Shared state server {self.host}:{self.port}: {str(e)}", sent=sent)
+
+    def incr(self, key, amount, ttl=None):
+        key = self.PREFIX + key
+        if ttl:
+            return self.execute([('INCRBY', key, amount), ('PEXPIRE', key, int(ttl * 1000))])[0]
+        return self.execute([('INCRBY', key, amount)])[0]
+
+    def incr_many(self, deltas):
+        if deltas:
+            try:
+                self.execute([('INCRBY', self.PREFIX + key, amount) for key, amount in deltas.items()])
+            except StateStoreError as e:
+                if e.sent:
+                    # Any part of the pipeline may have been applied: dropping it undercounts
+                    # at most one batch, resending it could count it twice
+                    e.applied = set(deltas)
+                raise
+
+    def get(self, key):
+        reply = self.execute([('GET', self.PREFIX + key)])[0]
+        return int(reply) if reply is not None else 0
+
+class LeasedTokenBudget:
+    """Tokens-per-minute budget shared by all workers through the state store
+
+    Each worker leases slices of the current minute's budget and spends them locally,
+    so the store is touched once per lease instead of once per request.
+    """
+
+    WINDOW = 60
+
+    def __init__(self, name, tokens_per_minute, store):
+        self.name = name
+        self.capacity = float(tokens_per_minute)
+        self.store = store
+        self.window = None
+        self.leased = 0
+        self.store_failed = False
+        self.lock = threading.Lock()
+
+    def _roll(self):
+        window = int(time.time() // self.WINDOW)
+        if window != self.window:
+            self.window = window
+            self.leased = 0
+
+    def _lease(self, window, needed):
+        """Lease tokens of a window from the store; called without holding the lock"""
+        amount = int(min(max(self.capacity * SHARED_STATE_LEASE_FRACTION, needed, 1), self.capacity))
+        total = self.store.incr(f"tpm:{self.name}:{window}", amount, ttl=self.WINDOW * 2)
+        return max(min(amount, self.capacity - (total - amount)), 0)
+
+    def available(self, tokens):
+        needed = min(tokens, self.capacity)
+        with self.lock:
+            self._roll()
+            if self.leased >= needed:
+                return True
+            window, missing = self.window, needed - self.leased
+        try:
+            granted = self._lease(window, missing)
+        except StateStoreError as e:
+            # Fail open: an unreachable store must not take the proxy down with it
+            with self.lock:
+                if not self.store_failed:
+                    logger.warning(f"Shared state unavailable, not enforcing tpm_limit of {self.name}: {str(e)}")
+                    self.store_failed = True
+            return True
+        with self.lock:
+            self.store_failed = False
+            self._roll()
+            if self.window == window:
+                self.leased += granted
+            return self.leased >= needed
+
+    def consume(self, tokens):
+        with self.lock:
+            self._roll()
+            self.leased -= tokens
+
+    def retry_after(self, tokens):
+        return max(math.ceil(self.WINDOW - time.time() % self.WINDOW), 1)
+
+class BatchedCounters:
+    """Counters accumulated in this worker and added to the state store in batches"""
+
+    def __init__(self, store):
+        self.store = store
+        self.pending = {}
+        self.ttls = {}
+        self.cached = {}
+        # Keys read through get(max_age) whose cached value is missing or too old
+        self.stale = set()
+        self.store_failed = False
+        self.lock = threading.Lock()
+
+    def add(self, key, amount=1, ttl=None):
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + amount
+            if ttl:
+                self.ttls[key] = ttl
+
+    def flush(self):
+        """Add the pending deltas to the store, then refresh the stale cached values"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            ttls, self.ttls = self.ttls, {}
+        remaining = dict(pending)
+        failed = False
+        try:
+            batch = {key: amount for key, amount in pending.items() if key not in ttls}
+            if batch:
+                self.store.incr_many(batch)
+            for key in batch:
+                del remaining[key]
+            # Expiring keys (daily quotas) are set one by one with their TTL
+            for key, ttl in ttls.items():
+                try:
+                    self.store.incr(key, pending[key], ttl)
+                except StateStoreError as e:
+                    if e.sent:
+                        e.applied.add(key)
+                    raise
+                del remaining[key]
+        except StateStoreError as e:
+            self._store_failed(e)
+            failed = True
+            for key in e.applied:
+                remaining.pop(key, None)
+        with self.lock:
+            for key in pending:
+                if key in remaining:
+                    # Keep the delta for the next flush
+                    self.pending[key] = self.pending.get(key, 0) + remaining[key]
+                    if key in ttls:
+                        self.ttls[key] = ttls[key]
+                elif key in self.cached:
+                    # The store value now includes the flushed delta
+                    value, read_at = self.cached[key]
+                    self.cached[key] = (value + pending[key], read_at)
+        if failed:
+            return
+        try:
+            self._refresh()
+        except StateStoreError as e:
+            self._store_failed(e)
+            return
+        if self.store_failed:
+            logger.info("Shared state is reachable again")
+            self.store_failed = False
+
+    def _store_failed(self, e):
+        if not self.store_failed:
+            logger.warning(f"Failed to flush stats to shared state: {str(e)}")
+            self.store_failed = True
+
+    def _refresh(self):
+        """Read the stale keys from the store; called by flush, never by request threads"""
+        with self.lock:
+            keys, self.stale = self.stale, set()
+        for key in keys:
+            try:
+                value = self.store.get(key)
+            except StateStoreError:
+                with self.lock:
+                    self.stale.update(keys)
+                raise
+            with self.lock:
+                if len(self.cached) > 1024:
+                    self.cached.clear()
+                self.cached[key] = (value, time.monotonic())
+
+    def get(self, key, max_age=0):
+        """Value in the store plus this worker's unflushed delta
+
+        With max_age, the store is not read on the caller's thread: the last value read is
+        used, and the next flush refreshes it once it is max_age seconds old. Until a key's
+        first refresh, only this worker's delta counts.
+        """
+        with self.lock:
+            local = self.pending.get(key, 0)
+            if max_age:
+                cached = self.cached.get(key)
+                if cached is None or time.monotonic() - cached[1] >= max_age:
+                    self.stale.add(key)
+                return (cached[0] if cached is not None else 0) + local
+        return self.store.get(key) + local
+
+def record_backend_stat(name, field, amount=1):
+    """Count a backend statistic (flushed to the shared state in batches)"""
+    if BACKEND_STATS is not None and name is not None:
+        BACKEND_STATS.add(f"stats:{name}:{field}", amount)
+
+def record_backend_usage(name, usage):
+    """Charge upstream-reported usage to a backend's token counters, daily quota and spend"""
+    if BACKEND_STATS is None:
+        return
+    api = next((api for api in (MULTI_BACKEND_CONFIG or {}).get('apis', []) if api.get('name') == name), {})
+    prompt_tokens = int(usage.get('prompt_tokens') or 0)
+    completion_tokens = int(usage.get('completion_tokens') or 0)
+    cached_tokens = usage.get('prompt_cache_hit_tokens') or (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+    cached_tokens = min(int(cached_tokens or 0), prompt_tokens)
+    input_price, output_price, cached_price = backend_prices(api)
+    # Prices are per million tokens, so tokens times price is the cost in millionths
+    spend_micros = round(
+        (prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price
+    )
+    record_backend_stat(name, 'usage_prompt_tokens', prompt_tokens)
+    record_backend_stat(name, 'usage_completion_tokens', completion_tokens)
+    record_backend_stat(name, 'spend_micros', spend_micros)
+    day = quota_day()
+    BACKEND_STATS.add(f"daily:{name}:{day}:tokens", prompt_tokens + completion_tokens, ttl=QUOTA_KEY_TTL)
+    BACKEND_STATS.add(f"daily:{name}:{day}:spend_micros", spend_micros, ttl=QUOTA_KEY_TTL)
+
+@app.teardown_request
+def account_backend_usage(exc):
+    """Charge a completion's usage to its backend once the response is sent
+
+    Responses without a usage object (streams without stream_options.include_usage)
+    are charged their estimated prompt tokens. Failed requests are not charged.
+    """
+    name = g.pop('usage_backend', None)
+    if name is None:
+        return
+    usage = g.pop('upstream_usage', None)
+    if not isinstance(usage, dict):
+        if exc is not None or g.get('response_status', 200) >= 400:
+            return
+        usage = {'prompt_tokens': g.get('prompt_estimate', 0)}
+    try:
+        record_backend_usage(name, usage)
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Ignoring malformed upstream usage: {str(e)}")
+
+def flush_backend_stats_loop():
+    """Periodically flush batched stats to the shared state"""
+    while True:
+        time.sleep(SHARED_STATE_FLUSH_INTERVAL)
+        BACKEND_STATS.flush()
+
+def load_shared_state_settings():
+    """Load shared state settings from the server section of the configuration"""
+    global SHARED_STATE_BACKEND, SHARED_STATE_PATH, SHARED_STATE_SLOTS, SHARED_STATE_URL
+    global SHARED_STATE_LEASE_FRACTION, SHARED_STATE_FLUSH_INTERVAL, SHARED_STATE_RETRY_INTERVAL
+    if not MULTI_BACKEND_CONFIG:
+        return
+    shared = (MULTI_BACKEND_CONFIG.get('server') or {}).get('shared_state') or {}
+    SHARED_STATE_BACKEND = str(shared.get('backend', SHARED_STATE_BACKEND)).lower()
+    SHARED_STATE_PATH = shared.get('path', SHARED_STATE_PATH)
+    SHARED_STATE_SLOTS = int(shared.get('slots', SHARED_STATE_SLOTS))
+    SHARED_STATE_URL = shared.get('url', SHARED_STATE_URL)
+    SHARED_STATE_LEASE_FRACTION = float(shared.get('lease_fraction', SHARED_STATE_LEASE_FRACTION))
+    SHARED_STATE_FLUSH_INTERVAL = float(shared.get('flush_interval', SHARED_STATE_FLUSH_INTERVAL))
+    SHARED_STATE_RETRY_INTERVAL = float(shared.get('retry_interval', SHARED_STATE_RETRY_INTERVAL))
+
+def open_shared_state():
+    """Open the configured shared state backend, falling back to in-process state"""
+    global SHARED_STATE, BACKEND_STATS
+    try:
+        if SHARED_STATE_BACKEND == 'shm':
+            path = SHARED_STATE_PATH or ("/dev/shm/trae_proxy_state" if os.path.isdir("/dev/shm") else "trae_proxy_state")
+            SHARED_STATE = SharedMemoryStateStore(path, SHARED_STATE_SLOTS)
+            logger.info(f"Shared state: shared memory table {path}")
+        elif SHARED_STATE_BACKEND == 'redis':
+            SHARED_STATE = RedisStateStore(SHARED_STATE_URL, retry_interval=SHARED_STATE_RETRY_INTERVAL)
+            try:
+                SHARED_STATE.execute([('PING',)])
+                logger.info(f"Shared state: {SHARED_STATE.host}:{SHARED_STATE.port}")
+            except StateStoreError as e:
+                logger.warning(f"Shared state server not reachable yet, limits fail open until it is: {str(e)}")
+        else:
+            SHARED_STATE = LocalStateStore()
+    except Exception as e:
+        logger.error(f"Failed to open {SHARED_STATE_BACKEND} shared state, using in-process state: {str(e)}")
+        SHARED_STATE = LocalStateStore()
+
+    BACKEND_STATS = BatchedCounters(SHARED_STATE)
+    with TPM_BUCKETS_LOCK:
+        TPM_BUCKETS.clear()
+    threading.Thread(target=flush_backend_stats_loop, name='stats-flush', daemon=True).start()
+
+@app.route('/admin/stats', methods=['GET'])
+def backend_stats():
+    """Per-backend request, error, token and spend counters, summed over the workers sharing state"""
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    backends = {}
+    compaction = None
+    if BACKEND_STATS is not None:
+        try:
+            for api in (MULTI_BACKEND_CONFIG or {}).get('apis', []):
+                name = api.get('name')
+                stats = {field: BACKEND_STATS.get(f"stats:{name}:{field}") for field in STAT_FIELDS}
+                stats['spend'] = stats.pop('spend_micros') / 1e6
+                stats['today'] = {
+                    "tokens": daily_usage(name, 'tokens', max_age=0),
+                    "spend": daily_usage(name, 'spend_micros', max_age=0) / 1e6,
+                    "quota": api.get('daily_token_quota'),
+                }
+                stats['healthy'] = backend_healthy(api)
+                backends[name] = stats
+            if COMPACTION_ENABLED:
+                compaction = {field: BACKEND_STATS.get(f"compaction:{field}") for field in COMPACTION_FIELDS}
+        except StateStoreError as e:
+            return jsonify({"error": f"Shared state unavailable: {str(e)}"}), 503
+    with BACKEND_INFLIGHT_LOCK:
+        inflight = dict(BACKEND_INFLIGHT)
+    buffered = sorted(REQUEST_MEMORY_SAMPLES)
+    return jsonify({
+        "shared_state": SHARED_STATE.name if SHARED_STATE is not None else None,
+        "backends": backends,
+        "compaction": compaction,
+        "inflight": inflight,
+        "memory": {
+            # ru_maxrss is in kilobytes on Linux
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None,
+            "request_buffered_bytes_estimate": {
+                "samples": len(buffered),
+                "p50": buffered[len(buffered) // 2] if buffered else 0,
+                "p99": buffered[min(int(len(buffered) * 0.99), len(buffered) - 1)] if buffered else 0,
+                "max": buffered[-1] if buffered else 0
+            }
+        }
+    })
+
+def get_upstream_session():
+    """Get the shared keep-alive session used for all upstream requests"""
+    global UPSTREAM_SESSION
+    if UPSTREAM_SESSION is None:
+        with UPSTREAM_SESSION_LOCK:
+            if UPSTREAM_SESSION is None:
+                session = requests.Session()
+                # Never persist upstream cookies across different clients
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=16, pool_maxsize=UPSTREAM_POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                UPSTREAM_SESSION = session
+    return UPSTREAM_SESSION
+
+def get_upstream_endpoints():
+    """Get the distinct endpoints of all active backends"""
+    endpoints = []
+    if MULTI_BACKEND_CONFIG:
+        for api in MULTI_BACKEND_CONFIG.get('apis', []):
+            endpoint = api.get('endpoint', '').strip()
+            if api.get('active', False) and endpoint and endpoint not in endpoints:
+                endpoints.append(endpoint)
+    else:
+        endpoints.append(TARGET_API_BASE_URL)
+    return endpoints
+
+def load_upstream_settings():
+    """Load upstream connection settings from the server section of the configuration"""
+    global UPSTREAM_PRECONNECT, UPSTREAM_POOL_MAXSIZE, UPSTREAM_CONNECT_TIMEOUT, DNS_CACHE_TTL, HTTP2_MAX_CONNECTIONS
+    if not MULTI_BACKEND_CONFIG:
+        return
+    upstream = (MULTI_BACKEND_CONFIG.get('server') or {}).get('upstream') or {}
+    UPSTREAM_PRECONNECT = int(upstream.get('preconnect', UPSTREAM_PRECONNECT))
+    UPSTREAM_POOL_MAXSIZE = max(int(upstream.get('pool_maxsize', UPSTREAM_POOL_MAXSIZE)), UPSTREAM_PRECONNECT)
+    UPSTREAM_CONNECT_TIMEOUT = float(upstream.get('connect_timeout', UPSTREAM_CONNECT_TIMEOUT))
+    DNS_CACHE_TTL = float(upstream.get('dns_ttl', DNS_CACHE_TTL))
+    HTTP2_MAX_CONNECTIONS = int(upstream.get('http2_max_connections', HTTP2_MAX_CONNECTIONS))
+
+def _endpoint_host_port(endpoint):
+    """Split an endpoint URL into host and port"""
+    parsed = urlparse(endpoint)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    return parsed.hostname, port
+
+def resolve_host(host, port):
+    """Resolve a host with the original resolver and store the result in the DNS cache"""
+    addresses = _original_getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with DNS_CACHE_LOCK:
+        DNS_CACHE[(host, port)] = (addresses, time.monotonic() + DNS_CACHE_TTL)
+    return addresses
+
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """getaddrinfo replacement that answers upstream lookups from the DNS cache"""
+    try:
+        key = (host, int(port))
+    except (TypeError, ValueError):
+        key = None
+    entry = DNS_CACHE.get(key) if key else None
+    if entry is None:
+        return _original_getaddrinfo(host, port, family, type, proto, flags)
+    # Entries past their TTL are still served; the refresher thread replaces them
+    return [
+        info for info in entry[0]
+        if (not family or info[0] == family) and (not type or info[1] == type)
+    ] or _original_getaddrinfo(host, port, family, type, proto, flags)
+
+def refresh_dns_cache():
+    """Background loop re-resolving cached upstream hosts before their TTL expires"""
+    while True:
+        time.sleep(max(DNS_CACHE_TTL / 2, 1))
+        with DNS_CACHE_LOCK:
+            keys = [key for key, (_, expires) in DNS_CACHE.items() if expires - time.monotonic() < DNS_CACHE_TTL / 2]
+        for host, port in keys:
+            try:
+                resolve_host(host, port)
+            except OSError as e:
+                # Keep serving the stale addresses rather than failing requests
+                logger.warning(f"DNS refresh failed for {host}: {str(e)}")
+
+def preconnect_endpoint(endpoint, count):
+    """Resolve an endpoint and open keep-alive connections into the shared pool
+
+    Each connection is opened by one of count concurrent HEAD requests. Streamed responses
+    hold their connections until all have arrived; reading them to the end then returns
+    the connections to the pool. Any status will do.
+    """
+    try:
+        host, port = _endpoint_host_port(endpoint)
+        resolve_host(host, port)
+        session = get_upstream_session()
+        timeout = (UPSTREAM_CONNECT_TIMEOUT, DEFAULT_TIMEOUTS['ttfb'])
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            responses = list(executor.map(
+                lambda _: session.head(endpoint, timeout=timeout, allow_redirects=False, stream=True), range(count)))
+        for response in responses:
+            response.content
+        logger.info(f"Pre-connected {count} connection(s) to {endpoint}")
+    except Exception as e:
+        logger.warning(f"Failed to pre-connect to {endpoint}: {str(e)}")
+
+def warm_up_upstreams():
+    """Populate the DNS cache and pre-connect to every active backend"""
+    socket.getaddrinfo = _cached_getaddrinfo
+    endpoints = get_upstream_endpoints()
+    if endpoints and UPSTREAM_PRECONNECT > 0:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            for endpoint in endpoints:
+                executor.submit(preconnect_endpoint, endpoint, UPSTREAM_PRECONNECT)
+    threading.Thread(target=refresh_dns_cache, name='dns-refresh', daemon=True).start()
+
+class Http2UpstreamResponse:
+    """Adapt an httpx response to the subset of the requests.Response API used by the proxy"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    def iter_content(self, chunk_size=None):
+        # httpx errors are raised as their requests counterparts, which the stream handlers catch
+        try:
+            for chunk in self._response.iter_bytes(chunk_size):
+                yield chunk
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(f"HTTP/2 upstream timeout: {str(e)}")
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(f"HTTP/2 upstream error: {str(e)}")
+        finally:
+            self._response.close()
+
+    def json(self):
+        try:
+            return json.loads(self._response.read())
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(f"HTTP/2 upstream timeout: {str(e)}")
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(f"HTTP/2 upstream error: {str(e)}")
+        finally:
+            self._response.close()
+
+    def close(self):
+        self._response.close()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} error from upstream {self._response.url}", response=self
+            )
+
+def import_httpx():
+    """Import httpx on first use, returning None unless it is installed with HTTP/2 support (h2)"""
+    global httpx, HTTPX_IMPORT_ATTEMPTED
+    if httpx is None and not HTTPX_IMPORT_ATTEMPTED:
+        HTTPX_IMPORT_ATTEMPTED = True
+        try:
+            import httpx as httpx_module
+            # httpx only imports h2 when an HTTP/2 client is created
+            import h2  # noqa: F401
+            httpx = httpx_module
+        except ImportError:
+            pass
+    return httpx
+
+def get_http2_client(endpoint):
+    """Get the shared HTTP/2 client for an endpoint, multiplexing streams over few connections"""
+    client = HTTP2_CLIENTS.get(endpoint)
+    if client is None:
+        with HTTP2_CLIENTS_LOCK:
+            client = HTTP2_CLIENTS.get(endpoint)
+            if client is None:
+                # Connections that do not negotiate h2 via ALPN fall back to HTTP/1.1
+                client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=HTTP2_MAX_CONNECTIONS),
+                    timeout=httpx.Timeout(DEFAULT_TIMEOUTS['ttfb'], connect=DEFAULT_TIMEOUTS['connect'])
+                )
+                HTTP2_CLIENTS[endpoint] = client
+    return client
+
+def load_timeout_settings():
+    """Load upstream timeout settings from the server section of the configuration"""
+    global ADAPTIVE_TIMEOUTS, ADAPTIVE_MIN_SAMPLES, ADAPTIVE_MULTIPLIER, ADAPTIVE_FLOOR
+    if not MULTI_BACKEND_CONFIG:
+        return
+    timeouts = (MULTI_BACKEND_CONFIG.get('server') or {}).get('timeouts') or {}
+    for phase in DEFAULT_TIMEOUTS:
+        if timeouts.get(phase) is not None:
+            DEFAULT_TIMEOUTS[phase] = float(timeouts[phase])
+    ADAPTIVE_TIMEOUTS = bool(timeouts.get('adaptive', ADAPTIVE_TIMEOUTS))
+    ADAPTIVE_MIN_SAMPLES = int(timeouts.get('adaptive_min_samples', ADAPTIVE_MIN_SAMPLES))
+    ADAPTIVE_MULTIPLIER = float(timeouts.get('adaptive_multiplier', ADAPTIVE_MULTIPLIER))
+    ADAPTIVE_FLOOR = float(timeouts.get('adaptive_floor', ADAPTIVE_FLOOR))
+
+def record_latency(backend_name, phase, seconds):
+    """Record an observed time-to-first-byte or inter-chunk gap for a backend"""
+    if not (ADAPTIVE_TIMEOUTS or ROUTING_STRATEGY == 'cost') or backend_name is None:
+        return
+    with LATENCY_SAMPLES_LOCK:
+        samples = LATENCY_SAMPLES.get((backend_name, phase))
+        if samples is None:
+            samples = LATENCY_SAMPLES[(backend_name, phase)] = deque(maxlen=200)
+        samples.append(seconds)
+
+def latency_percentile(backend_name, phase, percentile):
+    """Percentile of recent samples, or None if there are too few"""
+    with LATENCY_SAMPLES_LOCK:
+        samples = sorted(LATENCY_SAMPLES.get((backend_name, phase)) or ())
+    if len(samples) < ADAPTIVE_MIN_SAMPLES:
+        return None
+    return samples[min(int(len(samples) * percentile), len(samples) - 1)]
+
+def parse_timeout_header(value):
+    """Parse an X-Proxy-Timeouts header such as 'connect=5, ttfb=30, idle=20, total=120'"""
+    timeouts = {}
+    for item in (value or '').split(','):
+        phase, _, seconds = item.partition('=')
+        phase = phase.strip().lower()
+        try:
+            if phase in DEFAULT_TIMEOUTS and float(seconds) > 0:
+                timeouts[phase] = float(seconds)
+        except ValueError:
+            continue
+    return timeouts
+
+def resolve_timeouts(backend=None):
+    """Effective per-phase timeouts for a request to a backend
+
+    Backend settings override the server defaults; adaptive mode tightens TTFB and
+    idle limits to a multiple of the observed p99; a client may only shorten them.
+    """
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    backend_name = None
+    if backend:
+        backend_name = backend.get('name')
+        for phase, seconds in (backend.get('timeouts') or {}).items():
+            if phase in timeouts and seconds is not None:
+                timeouts[phase] = float(seconds)
+    if ADAPTIVE_TIMEOUTS and backend_name:
+        for phase in ('ttfb', 'idle'):
+            p99 = latency_percentile(backend_name, phase, 0.99)
+            if p99 is not None:
+                timeouts[phase] = min(timeouts[phase], max(ADAPTIVE_FLOOR, p99 * ADAPTIVE_MULTIPLIER))
+    for phase, seconds in parse_timeout_header(request.headers.get('X-Proxy-Timeouts')).items():
+        timeouts[phase] = min(timeouts[phase], seconds)
+    timeouts['ttfb'] = min(timeouts['ttfb'], timeouts['total'])
+    return timeouts
+
+def set_read_timeout(response, seconds):
+    """Change the socket read timeout of an in-progress HTTP/1.1 response"""
+    try:
+        response.raw._connection.sock.settimeout(seconds)
+    except AttributeError:
+        pass
+
+def post_upstream(target_url, req_json, headers, http2=False, endpoint=None, timeouts=None, backend_name=None,
+                  stream_body=False):
+    """Send a request to the upstream over HTTP/2 when enabled, otherwise over the HTTP/1.1 pool
+
+    The connect and time-to-first-byte limits apply until response headers arrive;
+    after that the socket read timeout becomes the inter-chunk idle limit. With
+    stream_body the JSON body is serialized while it is uploaded (chunked encoding).
+    """
+    timeouts = timeouts or DEFAULT_TIMEOUTS
+    started = time.monotonic()
+    if http2 and import_httpx() is None:
+        logger.warning("http2 is enabled but httpx[http2] is not installed, falling back to HTTP/1.1")
+    elif http2:
+        client = get_http2_client(endpoint or target_url)
+        try:
+            # httpx applies a single read timeout, so the TTFB limit also bounds idle gaps
+            body = {'content': iter_json_body(req_json)} if stream_body else {'json': req_json}
+            upstream_request = client.build_request(
+                'POST', target_url, headers=headers, **body,
+                timeout=httpx.Timeout(timeouts['ttfb'], connect=timeouts['connect'])
+            )
+            response = Http2UpstreamResponse(client.send(upstream_request, stream=True))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(f"HTTP/2 upstream timeout: {str(e)}")
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(f"HTTP/2 upstream error: {str(e)}")
+        record_latency(backend_name, 'ttfb', time.monotonic() - started)
+        return response
+
+    # Always stream so that headers mark the first byte and the body obeys the idle limit
+    body = {'data': iter_json_body(req_json)} if stream_body else {'json': req_json}
+    response = get_upstream_session().post(
+        target_url,
+        headers=headers,
+        stream=True,
+        **body,
+        timeout=(timeouts['connect'], timeouts['ttfb'])
+    )
+    elapsed = time.monotonic() - started
+    record_latency(backend_name, 'ttfb', elapsed)
+    set_read_timeout(response, max(min(timeouts['idle'], timeouts['total'] - elapsed), 0.001))
+    return response
+
+class DiskCompletionCache:
+    """Append-only segment of compressed responses with a memory-mapped open-addressing index
+
+    The index and segment files can be shared by several worker processes: lookups read
+    the mapped files directly, and writers serialize on an exclusive lock of the index.
+    """
+
+    MAGIC = b'TRAECCH1'
+    HEADER = struct.Struct('<8sII')      # magic, slot count, segment generation
+    HEADER_SIZE = 64
+    SLOT = struct.Struct('<16sQII')      # key digest, record offset, record length, expiry
+    RECORD = struct.Struct('<16sI')      # key digest, compressed body length
+    MAX_PROBES = 16
+
+    def __init__(self, path, max_bytes, slots, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(path, "index.bin")
+        self.segment_path = os.path.join(path, "segment.dat")
+        os.makedirs(path, exist_ok=True)
+
+        self.index_file = open(self.index_path, 'a+b')
+        index_size = self.HEADER_SIZE + slots * self.SLOT.size
+        with self._file_lock():
+            self.index_file.seek(0)
+            header = self.index_file.read(self.HEADER.size)
+            valid = len(header) == self.HEADER.size and self.HEADER.unpack(header)[:2] == (self.MAGIC, slots)
+            if not valid or os.fstat(self.index_file.fileno()).st_size != index_size:
+                # Missing or incompatible index: start over with an empty cache
+                self.index_file.truncate(0)
+                self.index_file.truncate(index_size)
+                self.index_file.flush()
+                open(self.segment_path, 'wb').close()
+            self.index = mmap.mmap(self.index_file.fileno(), index_size)
+            if not valid:
+                self.HEADER.pack_into(self.index, 0, self.MAGIC, slots, 0)
+        self.slots = slots
+        self.generation = None
+        self.segment_file = None
+        self.segment_map = None
+        self._open_segment()
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock on the index shared with other processes"""
+        if fcntl is not None:
+            fcntl.flock(self.index_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.index_file.fileno(), fcntl.LOCK_UN)
+
+    def _open_segment(self):
+        """(Re)open the segment file, e.g. after another process compacted it"""
+        if self.segment_map is not None:
+            self.segment_map.close()
+            self.segment_map = None
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment_file = open(self.segment_path, 'a+b')
+        self.generation = self.HEADER.unpack_from(self.index, 0)[2]
+
+    def _segment_view(self, end):
+        """Map the segment file so that it covers at least end bytes"""
+        if self.segment_map is None or len(self.segment_map) < end:
+            size = os.fstat(self.segment_file.fileno()).st_size
+            if size < end:
+                return None
+            if self.segment_map is not None:
+                self.segment_map.close()
+            self.segment_map = mmap.mmap(self.segment_file.fileno(), size, access=mmap.ACCESS_READ)
+        return self.segment_map
+
+    def _probe(self, digest):
+        """Yield the slot indexes to probe for a key digest"""
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        for i in range(self.MAX_PROBES):
+            yield (start + i) % self.slots
+
+    def _slot_offset(self, slot):
+        return self.HEADER_SIZE + slot * self.SLOT.size
+
+    def get(self, digest):
+        """Return the cached body for a key digest, or None"""
+        with self.lock:
+            if self.HEADER.unpack_from(self.index, 0)[2] != self.generation:
+                self._open_segment()
+            for slot in self._probe(digest):
+                key, offset, length, expires = self.SLOT.unpack_from(self.index, self._slot_offset(slot))
+                if key == bytes(16):
+                    return None
+                if key != digest:
+                    continue
+                if expires < time.time():
+                    return None
+                view = self._segment_view(offset + length)
+                if view is None:
+                    return None
+                record_key, size = self.RECORD.unpack_from(view, offset)
+                # Slots may be rewritten concurrently; trust only records that match the key
+                if record_key != digest or self.RECORD.size + size != length:
+                    return None
+                try:
+                    return zlib.decompress(view[offset + self.RECORD.size:offset + length])
+                except zlib.error:
+                    return None
+            return None
+
+    def put(self, digest, body):
+        """Append a response body and point the index at it"""
+        compressed = zlib.compress(body, 6)
+        record = self.RECORD.pack(digest, len(compressed)) + compressed
+        with self.lock, self._file_lock():
+            if self.HEADER.unpack_from(self.index, 0)[2] != self.generation:
+                self._open_segment()
+            offset = os.fstat(self.segment_file.fileno()).st_size
+            self.segment_file.write(record)
+            self.segment_file.flush()
+
+            target = None
+            for slot in self._probe(digest):
+                key = self.SLOT.unpack_from(self.index, self._slot_offset(slot))[0]
+                if key == digest or key == bytes(16):
+                    target = slot
+                    break
+            if target is None:
+                # Probe window full: evict the entry at the home slot
+                target = next(self._probe(digest))
+            self.SLOT.pack_into(self.index, self._slot_offset(target), digest, offset, len(record), int(time.time() + self.ttl))
+
+            if offset + len(record) > self.max_bytes:
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the segment keeping the newest live entries within half the size budget"""
+        now = time.time()
+        entries = []
+        for slot in range(self.slots):
+            key, offset, length, expires = self.SLOT.unpack_from(self.index, self._slot_offset(slot))
+            if key != bytes(16) and expires >= now:
+                entries.append((offset, length, key, expires))
+        entries.sort(reverse=True)
+
+        view = self._segment_view(os.fstat(self.segment_file.fileno()).st_size)
+        temp_path = self.segment_path + ".tmp"
+        kept = []
+        written = 0
+        with open(temp_path, 'wb') as f:
+            for offset, length, key, expires in entries:
+                if written + length > self.max_bytes // 2:
+                    break
+                f.write(view[offset:offset + length])
+                kept.append((key, written, length, expires))
+                written += length
+        os.replace(temp_path, self.segment_path)
+
+        self.index[self.HEADER_SIZE:] = bytes(len(self.index) - self.HEADER_SIZE)
+        for key, offset, length, expires in kept:
+            for slot in self._probe(key):
+                if self.SLOT.unpack_from(self.index, self._slot_offset(slot))[0] == bytes(16):
+                    self.SLOT.pack_into(self.index, self._slot_offset(slot), key, offset, length, expires)
+                    break
+        generation = (self.generation + 1) & 0xffffffff
+        self.HEADER.pack_into(self.index, 0, self.MAGIC, self.slots, generation)
+        self.index.flush()
+        self._open_segment()
+        logger.info(f"Compacted completion cache: kept {len(kept)} of {len(entries)} entries, {written} bytes")
+
+def load_completion_cache_settings():
+    """Load on-disk completion cache settings from the server section of the configuration"""
+    global COMPLETION_CACHE_ENABLED, COMPLETION_CACHE_PATH, COMPLETION_CACHE_MAX_BYTES, COMPLETION_CACHE_SLOTS, COMPLETION_CACHE_TTL
+    if not MULTI_BACKEND_CONFIG:
+        return
+    cache = (MULTI_BACKEND_CONFIG.get('server') or {}).get('completion_cache') or {}
+    COMPLETION_CACHE_ENABLED = bool(cache.get('enabled', COMPLETION_CACHE_ENABLED))
+    COMPLETION_CACHE_PATH = cache.get('path', COMPLETION_CACHE_PATH)
+    COMPLETION_CACHE_MAX_BYTES = int(cache.get('max_mb', COMPLETION_CACHE_MAX_BYTES // (1024 * 1024))) * 1024 * 1024
+    COMPLETION_CACHE_SLOTS = int(cache.get('index_slots', COMPLETION_CACHE_SLOTS))
+    COMPLETION_CACHE_TTL = int(cache.get('ttl', COMPLETION_CACHE_TTL))
+
+def open_completion_cache():
+    """Open the on-disk completion cache if it is enabled"""
+    global COMPLETION_CACHE
+    if not COMPLETION_CACHE_ENABLED:
+        return
+    try:
+        COMPLETION_CACHE = DiskCompletionCache(
+            COMPLETION_CACHE_PATH, COMPLETION_CACHE_MAX_BYTES, COMPLETION_CACHE_SLOTS, COMPLETION_CACHE_TTL
+        )
+        logger.info(f"Completion cache: {COMPLETION_CACHE_PATH} (max {COMPLETION_CACHE_MAX_BYTES // (1024 * 1024)} MB)")
+    except Exception as e:
+        logger.error(f"Failed to open completion cache: {str(e)}")
+
+def is_cacheable_request(req_json):
+    """Only deterministic, non-streaming, single-choice completions are cached"""
+    return (
+        not req_json.get('stream', False)
+        and req_json.get('temperature') == 0
+        and req_json.get('n', 1) == 1
+    )
+
+def completion_cache_key(target_url, req_json, auth_header):
+    """Digest identifying an upstream completion request"""
+    digest = hashlib.sha256()
+    digest.update(target_url.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update((auth_header or '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(req_json, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    return digest.digest()[:16]
+
+def generate_stream(response, deadline=None, backend_name=None):
+    """Generate streaming response, cutting off streams that stall or exceed the total deadline"""
+    trace = g.get('trace')
+    capture = g.get('capture')
+    chunks = [] if capture is not None else None
+    started = last_chunk = time.monotonic()
+    max_gap = 0.0
+    write_time = 0.0
+    first = True
+    # The last bytes hold the usage chunk when the client asked for stream_options.include_usage
+    tail = b''
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            now = time.monotonic()
+            max_gap = max(max_gap, now - last_chunk)
+            if first and trace is not None:
+                trace.add_span('upstream_first_chunk', started, now)
+                first = False
+            if chunks is not None and len(chunks) < CAPTURE_MAX_CHUNKS:
+                # Token cadence: gap since the previous chunk and chunk size
+                chunks.append([round((now - last_chunk) * 1000, 3), len(chunk)])
+            tail = (tail + chunk)[-USAGE_TAIL_SIZE:]
+            yield chunk
+            # Time suspended at yield is spent writing to the client
+            last_chunk = time.monotonic()
+            write_time += last_chunk - now
+            if deadline is not None and now > deadline:
+                logger.warning("Upstream stream exceeded its total deadline, closing")
+                yield b'data: {"error": "Upstream stream exceeded total timeout"}\n\n'
+                return
+        record_latency(backend_name, 'idle', max_gap)
+        g.upstream_usage = parse_usage_tail(tail)
+    except requests.exceptions.RequestException as e:
+        # A read timeout here means no chunk arrived within the idle limit
+        logger.warning(f"Upstream stream stalled or failed: {str(e)}")
+        yield b'data: {"error": "Upstream stream stalled"}\n\n'
+    finally:
+        response.close()
+        if trace is not None:
+            trace.add_span('stream_body', started, time.monotonic())
+            trace.attributes['client_write_ms'] = round(write_time * 1000, 3)
+            trace.attributes['max_chunk_gap_ms'] = round(max_gap * 1000, 3)
+        if capture is not None:
+            capture['chunks'] = chunks
 
 def simulate_stream(response_json):
     """Simulate streaming response from non-streaming response"""
@@ -172,13 +2696,41 @@ def chat_completions():
         if 'application/json' not in content_type:
             return jsonify({"error": "Content-Type must be application/json"}), 400
 
-        # Parse request JSON
+        # Reject oversized bodies from their declared length, before reading them
+        if MAX_REQUEST_BODY and (request.content_length or 0) > MAX_REQUEST_BODY:
+            return jsonify({"error": f"Request body exceeds the limit of {MAX_REQUEST_BODY} bytes"}), 413
+
+        # Parse request JSON, decoding compressed bodies first
         try:
-            req_json = request.json
-            if req_json is None:
+            body = read_request_body()
+            body_size = len(body)
+            track_buffered(body_size)
+            req_json = json.loads(body)
+            del body
+            if not isinstance(req_json, dict):
                 return jsonify({"error": "Invalid JSON request body"}), 400
+        except BodyDecodingError as e:
+            return jsonify({"error": str(e)}), e.status_code
         except Exception as e:
             return jsonify({"error": f"JSON parsing failed: {str(e)}"}), 400
+        trace_lap('parse_request')
+        if CAPTURE_ENABLED:
+            # Shapes only: roles and content sizes, never content
+            capture_set(
+                model=req_json.get('model', ''),
+                stream=bool(req_json.get('stream', False)),
+                max_tokens=req_json.get('max_tokens'),
+                messages=message_shapes(req_json)
+            )
+
+        # Compact repeated and stale context before it is estimated, cached and uploaded
+        if COMPACTION_ENABLED and request.headers.get('X-Proxy-Compaction', '').lower() != 'off':
+            compaction = compact_messages(req_json, compaction_session_key(req_json))
+            if compaction is not None:
+                body_size = max(body_size - compaction['bytes_saved'], 0)
+                trace_lap('compact_messages')
+                trace_attribute('compaction_bytes_saved', compaction['bytes_saved'])
+                capture_set(compaction=compaction)
 
         # Debug logging
         if DEBUG_MODE:
@@ -188,15 +2740,30 @@ def chat_completions():
         # Get requested model ID
         requested_model = req_json.get('model', '')
 
+        # Estimate the context needed, including the requested completion length
+        context_tokens = estimate_request_tokens(req_json)
+        g.prompt_estimate = context_tokens
+        max_tokens = req_json.get('max_tokens') or req_json.get('max_completion_tokens') or 0
+        if isinstance(max_tokens, int):
+            context_tokens += max_tokens
+        debug_log(f"Estimated context tokens: {context_tokens}")
+
         # Select backend API
+        selected_backend = None
         if MULTI_BACKEND_CONFIG:
             # Multi-backend mode: select backend based on model
-            selected_backend = select_backend_by_model(requested_model)
+            selected_backend = select_backend_by_model(requested_model, req_json, context_tokens)
             if selected_backend:
+                begin_backend_request(selected_backend)
                 target_api_url = selected_backend.get('endpoint', '').strip()
                 target_model_id = selected_backend.get('target_model_id', '').strip()
                 custom_model_id = selected_backend.get('custom_model_id', '').strip()
+                if is_equivalent_model(selected_backend, requested_model):
+                    # Served by an equivalent model: answer under the requested name
+                    custom_model_id = requested_model
                 stream_mode = selected_backend.get('stream_mode')
+                use_http2 = bool(selected_backend.get('http2', False))
+                backend_api_key = selected_backend.get('api_key')
 
                 logger.info(f"Selected backend: {selected_backend['name']} -> {target_api_url}")
 
@@ -224,6 +2791,8 @@ def chat_completions():
                 target_model_id = TARGET_MODEL_ID
                 custom_model_id = CUSTOM_MODEL_ID
                 stream_mode = STREAM_MODE
+                use_http2 = False
+                backend_api_key = None
 
                 logger.warning("Multi-backend configuration invalid, falling back to single backend mode")
 
@@ -247,6 +2816,8 @@ def chat_completions():
             target_model_id = TARGET_MODEL_ID
             custom_model_id = CUSTOM_MODEL_ID
             stream_mode = STREAM_MODE
+            use_http2 = False
+            backend_api_key = None
 
             # Modify model ID
             if 'model' in req_json:
@@ -268,8 +2839,8 @@ def chat_completions():
             'Content-Type': 'application/json'
         }
 
-        # Copy Authorization header
-        auth_header = request.headers.get('Authorization')
+        # Copy Authorization header, unless the backend is configured with its own key
+        auth_header = f"Bearer {backend_api_key}" if backend_api_key else request.headers.get('Authorization')
         if auth_header:
             headers['Authorization'] = auth_header
 
@@ -277,29 +2848,81 @@ def chat_completions():
         target_url = f"{target_api_url}/v1/chat/completions"
         debug_log(f"Forwarding request to: {target_url}")
 
-        # Send request to target API
-        response = requests.post(
-            target_url,
-            json=req_json,
-            headers=headers,
-            stream=req_json.get('stream', False),
-            timeout=300
-        )
+        # Per-phase upstream timeouts for this backend and request
+        timeouts = resolve_timeouts(selected_backend)
+        backend_name = selected_backend.get('name') if selected_backend else None
+        trace_lap('select_backend')
+        trace_attribute('model', requested_model)
+        trace_attribute('backend', backend_name or target_api_url)
+        trace_attribute('stream', bool(req_json.get('stream', False)))
+        deadline = time.monotonic() + timeouts['total']
 
-        # Check response status
-        response.raise_for_status()
+        # Look up deterministic requests in the completion cache
+        cache_key = None
+        cached_body = None
+        if COMPLETION_CACHE is not None and is_cacheable_request(req_json):
+            cache_key = completion_cache_key(target_url, req_json, auth_header)
+            cached_body = COMPLETION_CACHE.get(cache_key)
+            trace_lap('cache_lookup')
+            trace_attribute('cache_hit', cached_body is not None)
+
+        if cached_body is None:
+            # Large bodies are serialized chunk by chunk while they are uploaded
+            stream_body = bool(STREAM_UPLOAD_THRESHOLD) and body_size >= STREAM_UPLOAD_THRESHOLD
+            track_buffered(PASSTHROUGH_CHUNK_SIZE if stream_body else body_size)
+            if backend_name is not None:
+                g.usage_backend = backend_name
+
+            # Send request to target API
+            upstream_started = time.monotonic()
+            response = post_upstream(
+                target_url,
+                req_json,
+                headers,
+                http2=use_http2,
+                endpoint=target_api_url,
+                timeouts=timeouts,
+                backend_name=backend_name,
+                stream_body=stream_body
+            )
+
+            # Connect (or reuse) and wait for response headers
+            trace_lap('upstream_headers')
+            capture_set(upstream_headers_ms=round((time.monotonic() - upstream_started) * 1000, 3))
+
+            # Check response status
+            response.raise_for_status()
 
         # Process response
         if req_json.get('stream', False):
             # Streaming response
             debug_log("Returning streaming response")
             return Response(
-                stream_with_context(generate_stream(response)),
+                stream_with_context(generate_stream(response, deadline, backend_name)),
                 content_type=response.headers.get('Content-Type', 'text/event-stream')
             )
         else:
             # Non-streaming response
-            response_json = response.json()
+            if cached_body is None and cache_key is None and stream_mode != 'false' and not DEBUG_MODE:
+                # Nothing needs the parsed body: forward it as it arrives
+                debug_log("Forwarding non-streaming response incrementally")
+                return incremental_completion_response(response, custom_model_id, deadline, upstream_started)
+
+            if cached_body is not None:
+                debug_log("Serving response from completion cache")
+                response_json = json.loads(cached_body)
+                track_buffered(len(cached_body))
+            else:
+                response_json = response.json()
+                g.upstream_usage = response_json.get('usage')
+                track_buffered(len(getattr(response, 'content', b'')))
+                trace_lap('upstream_body')
+                capture_set(
+                    upstream_body_ms=round((time.monotonic() - upstream_started) * 1000, 3),
+                    usage=response_json.get('usage')
+                )
+                if cache_key is not None:
+                    COMPLETION_CACHE.put(cache_key, json.dumps(response_json, separators=(',', ':')).encode('utf-8'))
 
             if DEBUG_MODE:
                 debug_log(f"Response body: {json.dumps(response_json, ensure_ascii=False)}")
@@ -316,7 +2939,14 @@ def chat_completions():
             if 'model' in response_json:
                 response_json['model'] = custom_model_id
 
-            return jsonify(response_json)
+            response = compress_response(jsonify(response_json))
+            track_buffered(response.calculate_content_length() or 0)
+            trace_lap('serialize_response')
+            return response
+
+    except RoutingError as e:
+        # No backend can take the request; reject it before uploading anything
+        return routing_error_response(e)
 
     except requests.exceptions.HTTPError as e:
         # HTTP error
@@ -327,6 +2957,11 @@ def chat_completions():
         except:
             return jsonify({"error": f"HTTP error: {str(e)}"}), status_code
 
+    except requests.exceptions.Timeout as e:
+        # Upstream did not connect or respond within its timeouts
+        logger.error(f"Upstream timeout: {str(e)}")
+        return jsonify({"error": f"Upstream timeout: {str(e)}"}), 504
+
     except requests.exceptions.RequestException as e:
         # Request exception
         logger.error(f"Request exception: {str(e)}")
@@ -337,9 +2972,450 @@ def chat_completions():
         logger.error(f"Error processing request: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
-def main():
+def find_top_level_model(prefix):
+    """Locate the top-level "model" string value in the leading bytes of a JSON body"""
+    depth = 0
+    in_string = False
+    escaped = False
+    position = 0
+    for match in MODEL_FIELD_PATTERN.finditer(prefix):
+        # Track nesting up to the candidate so keys of nested objects are ignored
+        for byte in prefix[position:match.start()]:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif byte == 0x5c:
+                    escaped = True
+                elif byte == 0x22:
+                    in_string = False
+            elif byte == 0x22:
+                in_string = True
+            elif byte in (0x7b, 0x5b):
+                depth += 1
+            elif byte in (0x7d, 0x5d):
+                depth -= 1
+        position = match.start()
+        if depth == 1 and not in_string:
+            return match
+    return None
+
+def read_body_prefix(stream, size):
+    """Read up to size bytes from the start of the request body stream"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def iter_request_body(prefix, stream, chunk_size=PASSTHROUGH_CHUNK_SIZE):
+    """Yield the (possibly rewritten) body prefix followed by the unread rest of the stream"""
+    if prefix:
+        yield prefix
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+class StreamingRequestBody:
+    """Request body of known length that is streamed to the upstream without buffering"""
+
+    def __init__(self, prefix, stream, length):
+        self.prefix = prefix
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter_request_body(self.prefix, self.stream)
+
+def iter_raw_response(response, deadline=None):
+    """Yield upstream response bytes exactly as received, closing the connection afterwards"""
+    try:
+        for chunk in response.raw.stream(PASSTHROUGH_CHUNK_SIZE, decode_content=False):
+            yield chunk
+            if deadline is not None and time.monotonic() > deadline:
+                # Headers are already sent, so the body can only be cut short
+                logger.warning("Passthrough response exceeded its total deadline, closing")
+                return
+    finally:
+        response.close()
+
+def select_passthrough_target(requested_model):
+    """Select the endpoint, the model ID to send if it needs remapping, the backend's own key and the backend"""
+    # The model is only remapped when it names a configured custom model
+    if MULTI_BACKEND_CONFIG:
+        selected_backend = select_backend_by_model(requested_model)
+        if selected_backend:
+            begin_backend_request(selected_backend)
+            target_api_url = selected_backend.get('endpoint', '').strip()
+            mapped = (
+                selected_backend.get('custom_model_id') == requested_model
+                or is_equivalent_model(selected_backend, requested_model)
+            )
+            target_model_id = selected_backend.get('target_model_id', '').strip() if mapped else None
+            return target_api_url, target_model_id, selected_backend.get('api_key'), selected_backend
+
+    target_model_id = TARGET_MODEL_ID if requested_model == CUSTOM_MODEL_ID else None
+    return TARGET_API_BASE_URL, target_model_id, None, None
+
+@app.route('/v1/<path:subpath>', methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+def passthrough(subpath, body_stream=None):
+    """Forward any other /v1/* request to the backend selected by its model, streaming both bodies"""
+    try:
+        if body_stream is None:
+            body_stream = request.stream
+        content_length = request.content_length
+        prefix = b''
+        match = None
+        if request.method in ('POST', 'PUT', 'PATCH') and 'json' in request.headers.get('Content-Type', ''):
+            prefix = read_body_prefix(body_stream, PASSTHROUGH_PEEK_SIZE)
+            match = find_top_level_model(prefix)
+
+        requested_model = match.group(1).decode('utf-8', 'replace') if match else ''
+
+        target_api_url, target_model_id, backend_api_key, backend = select_passthrough_target(requested_model)
+
+        if match and target_model_id and target_model_id != requested_model:
+            replacement = json.dumps(target_model_id).encode('utf-8')
+            prefix = prefix[:match.start(1) - 1] + replacement + prefix[match.end(1) + 1:]
+            if content_length is not None:
+                content_length += len(replacement) - (match.end(1) - match.start(1) + 2)
+            debug_log(f"Passthrough model ID changed from {requested_model} to {target_model_id}")
+
+        # Forward end-to-end headers; the body length is recomputed above
+        headers = {
+            key: value for key, value in request.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in ('host', 'content-length')
+        }
+        if backend_api_key:
+            headers['Authorization'] = f"Bearer {backend_api_key}"
+
+        body = None
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            if content_length is not None:
+                body = StreamingRequestBody(prefix, body_stream, content_length)
+            else:
+                body = iter_request_body(prefix, body_stream)
+
+        target_url = f"{target_api_url}/v1/{subpath}"
+        if request.query_string:
+            target_url += '?' + request.query_string.decode('latin-1')
+        debug_log(f"Passthrough {request.method} to: {target_url}")
+
+        timeouts = resolve_timeouts(backend)
+        deadline = time.monotonic() + timeouts['total']
+        response = get_upstream_session().request(
+            request.method,
+            target_url,
+            data=body,
+            headers=headers,
+            stream=True,
+            timeout=(timeouts['connect'], timeouts['ttfb'])
+        )
+        set_read_timeout(response, timeouts['idle'])
+
+        response_headers = [
+            (key, value) for key, value in response.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        return Response(
+            stream_with_context(iter_raw_response(response, deadline)),
+            status=response.status_code,
+            headers=response_headers
+        )
+
+    except RoutingError as e:
+        return routing_error_response(e)
+
+    except requests.exceptions.Timeout as e:
+        logger.error(f"Passthrough upstream timeout: {str(e)}")
+        return jsonify({"error": f"Upstream timeout: {str(e)}"}), 504
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Passthrough request exception: {str(e)}")
+        return jsonify({"error": f"Request exception: {str(e)}"}), 503
+
+    except Exception as e:
+        logger.error(f"Error processing passthrough request: {str(e)}")
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+def load_embeddings_batching_settings():
+    """Load embeddings micro-batching settings from the server section of the configuration"""
+    global EMBEDDINGS_BATCHING, EMBEDDINGS_BATCH_WINDOW, EMBEDDINGS_BATCH_MAX_INPUTS, EMBEDDINGS_BATCH_MAX_BODY
+    if not MULTI_BACKEND_CONFIG:
+        return
+    batching = (MULTI_BACKEND_CONFIG.get('server') or {}).get('embeddings_batching') or {}
+    EMBEDDINGS_BATCHING = bool(batching.get('enabled', EMBEDDINGS_BATCHING))
+    EMBEDDINGS_BATCH_WINDOW = float(batching.get('window_ms', EMBEDDINGS_BATCH_WINDOW * 1000)) / 1000
+    EMBEDDINGS_BATCH_MAX_INPUTS = int(batching.get('max_inputs', EMBEDDINGS_BATCH_MAX_INPUTS))
+    EMBEDDINGS_BATCH_MAX_BODY = int(batching.get('max_body_bytes', EMBEDDINGS_BATCH_MAX_BODY))
+
+def normalize_embedding_inputs(value):
+    """Return embedding inputs as a list of single inputs, or None if they cannot be batched"""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and value:
+        if all(isinstance(item, str) for item in value):
+            return value
+        if all(isinstance(item, int) for item in value):
+            return [value]
+        if all(isinstance(item, list) and all(isinstance(token, int) for token in item) for item in value):
+            return value
+    return None
+
+class EmbeddingBatcher:
+    """Merge concurrent embedding requests for the same upstream call into one request"""
+
+    # Upstream statuses that blame some of the inputs rather than the whole call
+    INPUT_ERROR_STATUSES = (400, 413, 422)
+
+    def __init__(self, window, max_inputs):
+        self.window = window
+        self.max_inputs = max_inputs
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def submit(self, key, target_url, headers, payload, inputs, timeouts=None):
+        """Add inputs to the open batch for key and wait for this caller's share of the result
+
+        The upstream call uses the timeouts of the request that opened the batch; each
+        caller waits at most its own total timeout.
+        """
+        timeouts = timeouts or DEFAULT_TIMEOUTS
+        waiter = {'inputs': inputs, 'event': threading.Event(), 'status': None, 'body': None}
+        flush_now = None
+        overflow = None
+        with self.lock:
+            batch = self.pending.get(key)
+            if batch is not None and len(batch['inputs']) + len(inputs) > self.max_inputs:
+                # These inputs would push the open batch over max_inputs: send it as it is
+                batch['timer'].cancel()
+                del self.pending[key]
+                overflow = batch
+                batch = None
+            if batch is None:
+                batch = {
+                    'target_url': target_url, 'headers': headers, 'payload': payload, 'timeouts': timeouts,
+                    'inputs': [], 'waiters': [], 'timer': None, 'closed': False
+                }
+                self.pending[key] = batch
+                batch['timer'] = threading.Timer(self.window, self.flush, args=(key, batch))
+                batch['timer'].daemon = True
+                batch['timer'].start()
+            batch['inputs'].extend(inputs)
+            batch['waiters'].append(waiter)
+            if len(batch['inputs']) >= self.max_inputs:
+                batch['timer'].cancel()
+                flush_now = batch
+
+        if overflow is not None:
+            threading.Thread(target=self.flush, args=(key, overflow), daemon=True).start()
+        if flush_now is not None:
+            self.flush(key, flush_now)
+        if not waiter['event'].wait(timeouts['total']):
+            return 504, {"error": "Timed out waiting for batched embeddings"}
+        return waiter['status'], waiter['body']
+
+    def flush(self, key, batch):
+        """Send a batch upstream and hand each waiter its slice of the response"""
+        with self.lock:
+            if batch['closed']:
+                return
+            batch['closed'] = True
+            if self.pending.get(key) is batch:
+                del self.pending[key]
+
+        waiters = batch['waiters']
+        debug_log(f"Sending embeddings batch of {len(batch['inputs'])} inputs from {len(waiters)} requests")
+        try:
+            self._send(batch, waiters)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Embeddings batch request exception: {str(e)}")
+            for waiter in waiters:
+                if waiter['status'] is None:
+                    waiter['status'], waiter['body'] = 503, {"error": f"Request exception: {str(e)}"}
+        except Exception as e:
+            logger.error(f"Error processing embeddings batch: {str(e)}")
+            for waiter in waiters:
+                if waiter['status'] is None:
+                    waiter['status'], waiter['body'] = 500, {"error": f"Internal server error: {str(e)}"}
+        finally:
+            for waiter in waiters:
+                waiter['event'].set()
+
+    def _send(self, batch, waiters):
+        """Embed the inputs of some waiters in one upstream call
+
+        When the upstream rejects the inputs, each half of the waiters is sent again on its own,
+        so the error only reaches the requests that caused it.
+        """
+        inputs = [item for waiter in waiters for item in waiter['inputs']]
+        response = get_upstream_session().post(
+            batch['target_url'], json=dict(batch['payload'], input=inputs), headers=batch['headers'],
+            timeout=(batch['timeouts']['connect'], batch['timeouts']['ttfb'])
+        )
+        try:
+            response_json = response.json()
+        except ValueError:
+            response_json = {"error": f"Invalid upstream response: HTTP {response.status_code}"}
+        if response.status_code in self.INPUT_ERROR_STATUSES and len(waiters) > 1:
+            debug_log(f"Embeddings batch rejected with HTTP {response.status_code}, splitting {len(waiters)} requests")
+            middle = len(waiters) // 2
+            self._send(batch, waiters[:middle])
+            self._send(batch, waiters[middle:])
+            return
+        if response.status_code >= 400:
+            for waiter in waiters:
+                waiter['status'], waiter['body'] = response.status_code, response_json
+            return
+
+        data = sorted(response_json.get('data', []), key=lambda item: item.get('index', 0))
+        usage = response_json.get('usage') or {}
+        total_inputs = max(len(inputs), 1)
+        start = 0
+        for waiter in waiters:
+            count = len(waiter['inputs'])
+            items = []
+            for item in data[start:start + count]:
+                item = dict(item)
+                item['index'] = item.get('index', 0) - start
+                items.append(item)
+            body = {key: value for key, value in response_json.items() if key not in ('data', 'usage')}
+            body['data'] = items
+            if usage:
+                # Upstream usage covers the whole call; attribute it by share of inputs
+                body['usage'] = {
+                    name: round(value * count / total_inputs) if isinstance(value, (int, float)) else value
+                    for name, value in usage.items()
+                }
+            waiter['status'], waiter['body'] = 200, body
+            start += count
+
+def get_embedding_batcher():
+    """Get the shared embeddings batcher"""
+    global EMBEDDING_BATCHER
+    if EMBEDDING_BATCHER is None:
+        EMBEDDING_BATCHER = EmbeddingBatcher(EMBEDDINGS_BATCH_WINDOW, EMBEDDINGS_BATCH_MAX_INPUTS)
+    return EMBEDDING_BATCHER
+
+@app.route('/v1/embeddings', methods=['POST'])
+def embeddings():
+    """Handle embedding requests, micro-batching small concurrent requests when enabled"""
+    content_length = request.content_length
+    if (not EMBEDDINGS_BATCHING or content_length is None or content_length > EMBEDDINGS_BATCH_MAX_BODY
+            or 'application/json' not in request.headers.get('Content-Type', '')):
+        return passthrough('embeddings')
+
+    body = request.get_data()
+    try:
+        req_json = json.loads(body)
+    except ValueError:
+        req_json = None
+    inputs = normalize_embedding_inputs(req_json.get('input')) if isinstance(req_json, dict) else None
+    if inputs is None or len(inputs) >= EMBEDDINGS_BATCH_MAX_INPUTS:
+        return passthrough('embeddings', io.BytesIO(body))
+
+    requested_model = req_json.get('model', '')
+    try:
+        target_api_url, target_model_id, backend_api_key, backend = select_passthrough_target(requested_model)
+    except RoutingError as e:
+        return routing_error_response(e)
+    payload = {key: value for key, value in req_json.items() if key != 'input'}
+    if target_model_id:
+        payload['model'] = target_model_id
+
+    headers = {'Content-Type': 'application/json'}
+    auth_header = f"Bearer {backend_api_key}" if backend_api_key else request.headers.get('Authorization')
+    if auth_header:
+        headers['Authorization'] = auth_header
+
+    # Only requests with identical parameters, credentials and kind of input share an upstream call
+    target_url = f"{target_api_url}/v1/embeddings"
+    input_kind = 'tokens' if isinstance(inputs[0], list) else 'text'
+    key = (target_url, auth_header, input_kind, json.dumps(payload, sort_keys=True))
+    status_code, response_json = get_embedding_batcher().submit(
+        key, target_url, headers, payload, inputs, resolve_timeouts(backend)
+    )
+    if backend is not None and status_code < 400:
+        # This request's share of the batch usage counts toward the backend's quota and spend
+        g.usage_backend = backend.get('name')
+        g.upstream_usage = response_json.get('usage')
+    return jsonify(response_json), status_code
+
+def load_tls_settings():
+    """Load TLS serving settings from the server section of the configuration"""
+    global TLS_CIPHERS, TLS_NUM_TICKETS, TLS_RELOAD_INTERVAL
+    if not MULTI_BACKEND_CONFIG:
+        return
+    tls = (MULTI_BACKEND_CONFIG.get('server') or {}).get('tls') or {}
+    TLS_CIPHERS = tls.get('ciphers', TLS_CIPHERS)
+    TLS_NUM_TICKETS = int(tls.get('session_tickets', TLS_NUM_TICKETS))
+    TLS_RELOAD_INTERVAL = float(tls.get('reload_interval', TLS_RELOAD_INTERVAL))
+
+def build_server_ssl_context(cert_file, key_file):
+    """Create the server TLS context tuned for fast reconnects
+
+    TLS 1.2+ with forward-secret ECDHE suites only, session tickets for resumption
+    (keys live for the process lifetime, so IDE reconnects skip the full handshake),
+    and ALPN limited to http/1.1 because the built-in server does not speak HTTP/2.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(TLS_CIPHERS)
+    context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = TLS_NUM_TICKETS
+    context.set_alpn_protocols(['http/1.1'])
+    context.load_cert_chain(cert_file, key_file)
+    return context
+
+def watch_certificates(context, cert_file, key_file):
+    """Reload the certificate into the live context when the files change on disk"""
+    def mtimes():
+        return os.path.getmtime(cert_file), os.path.getmtime(key_file)
+
+    last = mtimes()
+    while True:
+        time.sleep(TLS_RELOAD_INTERVAL)
+        try:
+            current = mtimes()
+            if current != last:
+                # New handshakes use the new certificate; resumable sessions stay valid
+                context.load_cert_chain(cert_file, key_file)
+                last = current
+                logger.info(f"Reloaded certificate: {cert_file}")
+        except (OSError, ssl.SSLError) as e:
+            logger.error(f"Failed to reload certificate: {str(e)}")
+
+def signal_ready(ready_fd=None):
+    """Report that the listening socket is bound, to a supervisor pipe and/or systemd"""
+    if ready_fd is not None:
+        try:
+            os.write(ready_fd, b"ready\n")
+            os.close(ready_fd)
+        except OSError as e:
+            logger.warning(f"Failed to write readiness to fd {ready_fd}: {str(e)}")
+    notify_socket = os.environ.get('NOTIFY_SOCKET')
+    if notify_socket and hasattr(socket, 'AF_UNIX'):
+        # A leading @ names an abstract socket
+        address = '\0' + notify_socket[1:] if notify_socket.startswith('@') else notify_socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.connect(address)
+                sock.sendall(b"READY=1")
+        except OSError as e:
+            logger.warning(f"Failed to notify systemd: {str(e)}")
+
+def main(argv=None):
     """Main function"""
-    global TARGET_API_BASE_URL, CUSTOM_MODEL_ID, TARGET_MODEL_ID, STREAM_MODE, DEBUG_MODE
+    global TARGET_API_BASE_URL, CUSTOM_MODEL_ID, TARGET_MODEL_ID, STREAM_MODE, DEBUG_MODE, CERT_FILE, KEY_FILE
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Trae Proxy Server')
@@ -352,7 +3428,9 @@ def main():
     parser.add_argument('--key', help='Private key file path')
     parser.add_argument('--http-mode', action='store_true', help='Enable HTTP mode (no SSL, for use behind reverse proxy)')
     parser.add_argument('--port', type=int, help='Server port (default 443 for HTTPS mode, 8443 for HTTP mode)')
-    args = parser.parse_args()
+    parser.add_argument('--config', default='config.yaml', help='Configuration file path (default config.yaml)')
+    parser.add_argument('--ready-fd', type=int, help='File descriptor to write to once the listening socket is bound')
+    args = parser.parse_args(argv)
 
     # Determine running mode and port
     http_mode = args.http_mode
@@ -379,7 +3457,23 @@ def main():
         KEY_FILE = args.key
 
     # Load multi-backend configuration
-    load_multi_backend_config()
+    load_multi_backend_config(args.config)
+    load_upstream_settings()
+    load_embeddings_batching_settings()
+    load_routing_settings()
+    load_shared_state_settings()
+    load_timeout_settings()
+    load_compression_settings()
+    load_limits_settings()
+    load_compaction_settings()
+    load_tracing_settings()
+    load_capture_settings()
+    load_tls_settings()
+    load_models_settings()
+    load_completion_cache_settings()
+    build_models_response()
+    open_completion_cache()
+    open_shared_state()
 
     # HTTP mode does not require certificates
     if http_mode:
@@ -393,8 +3487,7 @@ def main():
             sys.exit(1)
 
         # Create SSL context
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(CERT_FILE, KEY_FILE)
+        context = build_server_ssl_context(CERT_FILE, KEY_FILE)
         logger.info(f"Certificate file: {CERT_FILE}")
         logger.info(f"Private key file: {KEY_FILE}")
 
@@ -415,14 +3508,24 @@ def main():
 
     # Start server
     logger.info("Starting proxy server...")
+    from werkzeug.serving import make_server
     if http_mode:
         # HTTP mode - no SSL
-        app.run(host='0.0.0.0', port=port, threaded=True)
+        server = make_server('0.0.0.0', port, app, threaded=True)
     else:
         # HTTPS mode - with SSL context
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(CERT_FILE, KEY_FILE)
-        app.run(host='0.0.0.0', port=port, ssl_context=context, threaded=True)
+        if TLS_RELOAD_INTERVAL > 0:
+            threading.Thread(target=watch_certificates, args=(context, CERT_FILE, KEY_FILE), name='cert-reload', daemon=True).start()
+        server = make_server('0.0.0.0', port, app, threaded=True, ssl_context=context)
+
+    # Ready as soon as the socket is bound; upstream warm-up continues in the background
+    signal_ready(args.ready_fd)
+    threading.Thread(target=warm_up_upstreams, name='warm-up', daemon=True).start()
+    if MODELS_MERGE_UPSTREAM and MULTI_BACKEND_CONFIG:
+        threading.Thread(target=refresh_upstream_models_loop, name='models-refresh', daemon=True).start()
+
+    logger.info(f"Serving on {'http' if http_mode else 'https'}://0.0.0.0:{port}")
+    server.serve_forever()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,9 +5,9 @@ import os
 import sys
 import subprocess
 import argparse
-import yaml
 import json
 import logging
+import time
 from urllib.parse import urlparse
 
 # Configure logging
@@ -20,10 +20,16 @@ logger = logging.getLogger('trae_proxy_cli')
 # Global variables
 config_file = "config.yaml"
 
-def load_config():
-    """Load configuration from config file"""
+def load_config(read=None):
+    """Load configuration from config file
+
+    read, if given, parses the file instead of PyYAML (e.g. trae_proxy.read_config_file and its snapshot).
+    """
     try:
         if os.path.exists(config_file):
+            if read is not None:
+                return read(config_file)
+            import yaml
             with open(config_file, 'r', encoding='utf-8') as f:
                 data = yaml.safe_load(f)
                 return data
@@ -69,6 +75,7 @@ def load_config():
 def save_config(config):
     """Save configuration to config file"""
     try:
+        import yaml
         with open(config_file, 'w', encoding='utf-8') as f:
             yaml.dump(config, f, allow_unicode=True)
         logger.info(f"Configuration saved to {config_file}")
@@ -297,9 +304,14 @@ def generate_certificates(domain=None):
         logger.error(f"Certificate generation failed, return code: {process.returncode}")
         return False
 
-def start_proxy_server(debug=False, http_mode=False, port=None):
+def start_proxy_server(debug=False, http_mode=False, port=None, health_port=None, single_process=False):
     """Start proxy server"""
-    config = load_config()
+    if single_process:
+        # The proxy module is loaded anyway: read the configuration through its snapshot, without PyYAML
+        import trae_proxy
+        config = load_config(trae_proxy.read_config_file)
+    else:
+        config = load_config()
     domain = config.get('domain', 'api.openai.com')
     apis = config.get('apis', [])
 
@@ -320,7 +332,7 @@ def start_proxy_server(debug=False, http_mode=False, port=None):
         logger.info(f"  - {api['name']} [{status}]: {api.get('endpoint', '')} -> {api.get('custom_model_id', '')}")
 
     # Build command - no longer passing specific API parameters, let proxy server automatically select based on config file
-    cmd = [sys.executable, "trae_proxy.py"]
+    cmd = [sys.executable, "trae_proxy.py", "--config", config_file]
 
     # HTTP mode does not require certificates
     if http_mode:
@@ -353,44 +365,500 @@ def start_proxy_server(debug=False, http_mode=False, port=None):
     logger.info(f"Starting proxy server: {' '.join(cmd)}")
     logger.info("Proxy server will automatically select backend API based on requested model ID")
 
-    # Execute command
+    if single_process:
+        # Serve from this interpreter: no second process start and no supervisor
+        import trae_proxy
+        trae_proxy.main(cmd[2:])
+        return True
+
+    settings = load_supervisor_settings(config)
+    if health_port is not None:
+        settings['health_port'] = health_port
+    return supervise_proxy(cmd, port, http_mode, settings)
+
+SUPERVISOR_DEFAULTS = {
+    "restart": True,
+    "backoff_initial": 1,
+    "backoff_max": 30,
+    "reset_after": 60,
+    "max_restarts": 0,
+    "startup_timeout": 60,
+    "probe_interval": 5,
+    "probe_timeout": 2,
+    "probe_failures": 3,
+    "health_port": None
+}
+
+def load_supervisor_settings(config):
+    """Supervisor settings from server.supervisor, falling back to defaults"""
+    settings = dict(SUPERVISOR_DEFAULTS)
+    settings.update((config.get('server') or {}).get('supervisor') or {})
+    return settings
+
+def probe_proxy(port, https=False, timeout=2):
+    """Return True when the proxy's /healthz endpoint answers 200"""
+    import ssl
+    import urllib.request
+
+    scheme = "https" if https else "http"
+    # The proxy's certificate is issued for the public domain, not 127.0.0.1
+    context = ssl._create_unverified_context() if https else None
     try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
-        )
-
-        # Read output
-        for line in process.stdout:
-            print(line.strip())
-
-        # Wait for process to complete
-        process.wait()
-
-        if process.returncode != 0:
-            logger.error(f"Proxy server exited abnormally, return code: {process.returncode}")
+        with urllib.request.urlopen(f"{scheme}://127.0.0.1:{port}/healthz", timeout=timeout, context=context) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+class ProxySupervisor:
+    """Run the proxy as a child process, probe it and restart it with backoff
+
+    The child inherits stdout/stderr, so its logs never pass through this process.
+    """
+
+    def __init__(self, cmd, port, https, settings):
+        import threading
+
+        self.cmd = cmd
+        self.port = port
+        self.https = https
+        self.settings = settings
+        self.process = None
+        self.state = "stopped"
+        self.restarts = 0
+        self.last_exit_code = None
+        self.started_at = None
+        self.ready_at = None
+        self.probe_failures = 0
+        self.last_probe_ms = None
+        self.ready_pipe = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def status(self):
+        """Worker state as reported by the health endpoint"""
+        with self.lock:
+            running = self.process is not None and self.process.poll() is None
+            return {
+                "state": self.state,
+                "pid": self.process.pid if running else None,
+                "restarts": self.restarts,
+                "last_exit_code": self.last_exit_code,
+                "uptime_seconds": round(time.monotonic() - self.started_at, 1) if running else None,
+                "probe_failures": self.probe_failures,
+                "last_probe_ms": self.last_probe_ms
+            }
+
+    def set_state(self, state):
+        with self.lock:
+            self.state = state
+
+    def probe(self):
+        started = time.monotonic()
+        ok = probe_proxy(self.port, self.https, self.settings['probe_timeout'])
+        self.last_probe_ms = round((time.monotonic() - started) * 1000, 1)
+        return ok
+
+    def start_worker(self):
+        logger.info(f"Starting proxy worker: {' '.join(self.cmd)}")
+        cmd = self.cmd
+        pass_fds = ()
+        self.close_ready_pipe()
+        if os.name == 'posix':
+            # The worker writes to this pipe as soon as its socket is bound
+            self.ready_pipe, ready_write = os.pipe()
+            cmd = cmd + ["--ready-fd", str(ready_write)]
+            pass_fds = (ready_write,)
+        with self.lock:
+            self.process = subprocess.Popen(cmd, pass_fds=pass_fds)
+            self.state = "starting"
+            self.started_at = time.monotonic()
+            self.ready_at = None
+            self.probe_failures = 0
+        if pass_fds:
+            os.close(pass_fds[0])
+
+    def close_ready_pipe(self):
+        if self.ready_pipe is not None:
+            os.close(self.ready_pipe)
+            self.ready_pipe = None
+
+    def wait_ready_signal(self, timeout):
+        """Wait up to timeout for the worker's readiness message; False if none arrived"""
+        if self.ready_pipe is None:
+            self.stopping.wait(timeout)
+            return False
+        import select
+
+        readable, _, _ = select.select([self.ready_pipe], [], [], timeout)
+        if not readable:
             return False
+        data = os.read(self.ready_pipe, 64)
+        # Either way the pipe is done: a message, or EOF because the worker exited or closed it
+        self.close_ready_pipe()
+        return bool(data)
+
+    def stop_worker(self, timeout=10):
+        process = self.process
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Proxy worker {process.pid} did not exit within {timeout}s, killing it")
+            process.kill()
+            process.wait()
+
+    def watch_worker(self):
+        """Block until the worker exits, stops answering probes, or the supervisor is stopped"""
+        settings = self.settings
+        while not self.stopping.is_set():
+            if self.process.poll() is not None:
+                return "exited"
+
+            if self.ready_at is None:
+                if self.wait_ready_signal(0.2) or self.probe():
+                    self.ready_at = time.monotonic()
+                    self.set_state("ready")
+                    logger.info(f"Proxy worker {self.process.pid} is ready on port {self.port} "
+                                f"({self.ready_at - self.started_at:.2f}s after start)")
+                elif time.monotonic() - self.started_at > settings['startup_timeout']:
+                    logger.error(f"Proxy worker did not become ready within {settings['startup_timeout']}s")
+                    return "unready"
+                continue
+
+            self.stopping.wait(settings['probe_interval'])
+            if self.stopping.is_set() or self.process.poll() is not None:
+                continue
+            if self.probe():
+                with self.lock:
+                    self.probe_failures = 0
+                    if self.state != "ready":
+                        self.state = "ready"
+                continue
+            with self.lock:
+                self.probe_failures += 1
+                self.state = "unhealthy"
+            logger.warning(f"Proxy worker health probe failed ({self.probe_failures}/{settings['probe_failures']})")
+            if self.probe_failures >= settings['probe_failures']:
+                return "unhealthy"
+        return "stopped"
+
+    def run(self):
+        """Supervise the worker until it exits cleanly or the supervisor is stopped"""
+        settings = self.settings
+        backoff = settings['backoff_initial']
+        while not self.stopping.is_set():
+            self.start_worker()
+            reason = self.watch_worker()
+            if reason != "exited":
+                self.stop_worker()
+            exit_code = self.process.returncode
+            with self.lock:
+                self.last_exit_code = exit_code
+                self.state = "stopped"
+
+            if self.stopping.is_set():
+                break
+            if reason == "exited" and exit_code == 0:
+                logger.info("Proxy worker exited normally")
+                return True
+            logger.error(f"Proxy worker {reason}, return code: {exit_code}")
+            if not settings['restart']:
+                return False
+            if settings['max_restarts'] and self.restarts >= settings['max_restarts']:
+                logger.error(f"Giving up after {self.restarts} restarts")
+                return False
 
+            # Reset the backoff once a worker has stayed ready long enough
+            if self.ready_at is not None and time.monotonic() - self.ready_at >= settings['reset_after']:
+                backoff = settings['backoff_initial']
+            self.set_state("backoff")
+            logger.info(f"Restarting proxy worker in {backoff}s")
+            if self.stopping.wait(backoff):
+                break
+            backoff = min(backoff * 2, settings['backoff_max'])
+            with self.lock:
+                self.restarts += 1
         return True
 
+def make_supervisor_health_handler(supervisor):
+    """Build the handler for the supervisor's own health endpoint"""
+    from http.server import BaseHTTPRequestHandler
+
+    class SupervisorHealthHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            status = supervisor.status()
+            body = json.dumps(status).encode('utf-8')
+            self.send_response(200 if status['state'] == "ready" else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return SupervisorHealthHandler
+
+def supervise_proxy(cmd, port, http_mode, settings):
+    """Run the proxy under a supervisor, optionally serving worker state on a health port"""
+    import signal
+    import threading
+    from http.server import ThreadingHTTPServer
+
+    supervisor = ProxySupervisor(cmd, port, not http_mode, settings)
+
+    health_server = None
+    if settings.get('health_port'):
+        health_server = ThreadingHTTPServer(('0.0.0.0', settings['health_port']), make_supervisor_health_handler(supervisor))
+        health_server.daemon_threads = True
+        threading.Thread(target=health_server.serve_forever, name='supervisor-health', daemon=True).start()
+        logger.info(f"Supervisor health endpoint listening on port {settings['health_port']}")
+
+    # docker stop sends SIGTERM to the supervisor only
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stopping.set())
+
+    try:
+        return supervisor.run()
+
     except KeyboardInterrupt:
         logger.info("Received interrupt signal, stopping proxy server...")
-        process.terminate()
-        process.wait()
-        logger.info("Proxy server stopped")
+        supervisor.stopping.set()
         return True
 
     except Exception as e:
         logger.error(f"Error starting proxy server: {str(e)}")
         return False
 
+    finally:
+        supervisor.stop_worker()
+        supervisor.close_ready_pipe()
+        if health_server is not None:
+            health_server.shutdown()
+        if supervisor.stopping.is_set():
+            logger.info("Proxy server stopped")
+
+def load_capture_log(log_file, limit=None):
+    """Load capture records written by the proxy, ordered by arrival time"""
+    entries = []
+    with open(log_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping malformed capture record")
+    entries.sort(key=lambda entry: entry.get('t', 0))
+    return entries[:limit] if limit else entries
+
+def make_replay_upstream_handler(entries):
+    """Build a mock upstream handler that reproduces the captured TTFT and token cadence"""
+    from http.server import BaseHTTPRequestHandler
+
+    class ReplayUpstreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            body = json.dumps({"object": "list", "data": []}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            req_json = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            # The replay client tags each request with its capture record index
+            try:
+                entry = entries[int(str(req_json.get('user', '')).rsplit('-', 1)[-1])]
+            except (ValueError, IndexError):
+                entry = {}
+
+            if not req_json.get('stream'):
+                time.sleep(entry.get('upstream_body_ms', 0) / 1000)
+                completion_tokens = (entry.get('usage') or {}).get('completion_tokens', 16)
+                body = json.dumps({
+                    "id": "chatcmpl-replay", "object": "chat.completion", "model": req_json.get('model'),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "x" * (completion_tokens * 4)}, "finish_reason": "stop"}],
+                    "usage": entry.get('usage') or {}
+                }).encode('utf-8')
+                self.send_response(entry.get('status', 200))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            time.sleep(entry.get('upstream_headers_ms', 0) / 1000)
+            self.send_response(entry.get('status', 200))
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for gap_ms, size in entry.get('chunks') or [[0, 64]]:
+                    time.sleep(gap_ms / 1000)
+                    prefix = b'data: {"choices":[{"index":0,"delta":{"content":"'
+                    suffix = b'"}}]}\n\n'
+                    chunk = prefix + b'x' * max(size - len(prefix) - len(suffix), 0) + suffix
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    self.wfile.flush()
+                done = b'data: [DONE]\n\n'
+                self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(done), done))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return ReplayUpstreamHandler
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def replay_traffic(log_file, speed=1.0, proxy_url=None, proxy_port=18443, mock_port=18080, limit=None, concurrency=256):
+    """Replay a capture log against a local mock upstream and the proxy, then report latency and throughput"""
+    import threading
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import ThreadingHTTPServer
+
+    entries = load_capture_log(log_file, limit)
+    if not entries:
+        logger.error(f"No capture records found in {log_file}")
+        return False
+    logger.info(f"Loaded {len(entries)} capture records from {log_file}")
+
+    # Mock upstream reproducing the captured upstream timing
+    mock_server = ThreadingHTTPServer(('127.0.0.1', mock_port), make_replay_upstream_handler(entries))
+    mock_server.daemon_threads = True
+    threading.Thread(target=mock_server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+
+    process = None
+    config_path = None
+    if proxy_url is None:
+        # Start a proxy whose every captured model points at the mock upstream
+        models = sorted({entry.get('model') or 'gpt-4' for entry in entries})
+        replay_config = {
+            "apis": [
+                {"name": model, "endpoint": mock_url, "custom_model_id": model,
+                 "target_model_id": model, "stream_mode": None, "active": True}
+                for model in models
+            ],
+            "server": {"port": proxy_port, "debug": False, "upstream": {"preconnect": 0}}
+        }
+        import tempfile
+        import yaml
+        fd, config_path = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yaml.dump(replay_config, f, allow_unicode=True)
+        cmd = [sys.executable, "trae_proxy.py", "--http-mode", "--port", str(proxy_port), "--config", config_path]
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+
+    try:
+        # Wait for the proxy to accept requests
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(f"{proxy_url}/v1/models", timeout=1)
+                break
+            except requests.exceptions.RequestException:
+                if time.monotonic() > deadline or (process is not None and process.poll() is not None):
+                    logger.error(f"Proxy at {proxy_url} did not become ready")
+                    return False
+                time.sleep(0.1)
+
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        results = []
+        results_lock = threading.Lock()
+
+        def send(index, entry):
+            payload = {
+                "model": entry.get('model') or 'gpt-4',
+                "stream": bool(entry.get('stream')),
+                "messages": [{"role": role or 'user', "content": "x" * size} for role, size in entry.get('messages') or []],
+                "user": f"replay-{index}"
+            }
+            if entry.get('max_tokens'):
+                payload['max_tokens'] = entry['max_tokens']
+            started = time.monotonic()
+            ttfb = None
+            received = 0
+            status = 0
+            try:
+                response = session.post(f"{proxy_url}/v1/chat/completions", json=payload, stream=True, timeout=600)
+                status = response.status_code
+                for chunk in response.iter_content(chunk_size=None):
+                    if ttfb is None:
+                        ttfb = time.monotonic() - started
+                    received += len(chunk)
+                response.close()
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Replay request {index} failed: {str(e)}")
+            with results_lock:
+                results.append({
+                    "status": status, "latency": time.monotonic() - started,
+                    "ttfb": ttfb if ttfb is not None else time.monotonic() - started, "bytes": received
+                })
+
+        logger.info(f"Replaying at {speed}x against {proxy_url}")
+        origin = entries[0].get('t', 0)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for index, entry in enumerate(entries):
+                # Keep the captured inter-arrival times, compressed by the speed factor
+                delay = (entry.get('t', origin) - origin) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, index, entry)
+        elapsed = time.monotonic() - started
+
+        latencies = [result['latency'] * 1000 for result in results]
+        ttfbs = [result['ttfb'] * 1000 for result in results]
+        errors = sum(1 for result in results if not 200 <= result['status'] < 300)
+        captured_span = (entries[-1].get('t', origin) - origin) or 0
+
+        print("\nReplay results:")
+        print("-" * 80)
+        print(f"Requests: {len(results)} ({errors} errors)")
+        print(f"Speed: {speed}x, captured span {captured_span:.1f}s, replayed in {elapsed:.1f}s")
+        print(f"Throughput: {len(results) / elapsed if elapsed else 0:.2f} req/s, "
+              f"{sum(result['bytes'] for result in results) / elapsed / 1024 if elapsed else 0:.1f} KB/s")
+        print(f"Latency ms: p50 {percentile(latencies, 0.5):.1f}, p90 {percentile(latencies, 0.9):.1f}, "
+              f"p99 {percentile(latencies, 0.99):.1f}, max {max(latencies, default=0):.1f}")
+        print(f"TTFB ms: p50 {percentile(ttfbs, 0.5):.1f}, p90 {percentile(ttfbs, 0.9):.1f}, "
+              f"p99 {percentile(ttfbs, 0.99):.1f}")
+        print("-" * 80)
+        return errors == 0
+
+    finally:
+        mock_server.shutdown()
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if config_path is not None:
+            from trae_proxy import config_snapshot_path
+            for path in (config_path, config_snapshot_path(config_path)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
 def main():
     """Main function"""
+    global config_file
+
     parser = argparse.ArgumentParser(description='Trae Proxy Command Line Tool')
+    parser.add_argument('--config', default=config_file, help='Configuration file path (default config.yaml)')
     subparsers = parser.add_subparsers(dest='command', help='Subcommands')
 
     # list command
@@ -436,9 +904,22 @@ def main():
     start_parser.add_argument('--debug', action='store_true', help='Enable debug mode')
     start_parser.add_argument('--http-mode', action='store_true', help='Enable HTTP mode (no SSL, for use behind reverse proxy)')
     start_parser.add_argument('--port', type=int, help='Server port (default 443 for HTTPS mode, 8443 for HTTP mode)')
+    start_parser.add_argument('--single-process', action='store_true', help='Run the proxy in this process, without a supervisor (fastest start)')
+    start_parser.add_argument('--health-port', type=int, help='Serve supervisor/worker state on this port (default server.supervisor.health_port)')
+
+    # replay command
+    replay_parser = subparsers.add_parser('replay', help='Replay captured traffic against a mock upstream and the proxy')
+    replay_parser.add_argument('--log', default='capture.jsonl', help='Capture log written by the proxy (default capture.jsonl)')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='Arrival rate multiplier (default 1.0)')
+    replay_parser.add_argument('--proxy-url', help='Replay against an already running proxy instead of starting one')
+    replay_parser.add_argument('--proxy-port', type=int, default=18443, help='Port for the proxy started by replay (default 18443)')
+    replay_parser.add_argument('--mock-port', type=int, default=18080, help='Port of the mock upstream (default 18080)')
+    replay_parser.add_argument('--limit', type=int, help='Replay only the first N records')
+    replay_parser.add_argument('--concurrency', type=int, default=256, help='Maximum concurrent replay requests (default 256)')
 
     # Parse command line arguments
     args = parser.parse_args()
+    config_file = args.config
 
     # Execute command
     if args.command == 'list':
@@ -469,7 +950,12 @@ def main():
     elif args.command == 'start':
         http_mode = getattr(args, 'http_mode', False)
         port = getattr(args, 'port', None)
-        start_proxy_server(args.debug, http_mode, port)
+        if not start_proxy_server(args.debug, http_mode, port, args.health_port, args.single_process):
+            sys.exit(1)
+
+    elif args.command == 'replay':
+        if not replay_traffic(args.log, args.speed, args.proxy_url, args.proxy_port, args.mock_port, args.limit, args.concurrency):
+            sys.exit(1)
 
     else:
         parser.print_help()